@@ -1,40 +1,119 @@
 from __future__ import division
 import collections
 import config
+import csr
+import indexes
+import itertools
 import logging
-import math
-import operator
+import metrics
+import multiprocessing
+import os
 import os.path
 import re
 import repos
+import scoring
+import time
 import tokyo
 import users
 import util
 
 logger = logging.getLogger("ghc.analyzers")
 
-class Analysis:
+def _open_reader(cache=None):
+    """
+    Opens the model in the format set by config.MODEL_FORMAT.
+    Readers share the given neighbor cache.
+    """
+    if config.MODEL_FORMAT == 'csr':
+        return csr.Reader(cache=cache)
+    return tokyo.Reader(cache)
+
+class Analysis(object):
+    """
+    The candidate generation stages. The datasets they use are
+    loaded on first access, so a stage only pays for the data
+    it actually touches.
+    """
     def __init__(self):
-        self.user_watches = users.get_user_watches()
-        self.repo_freqs = users.get_repo_frequencies()
-        self.repos = repos.get_repos()
-        self.test_users = users.get_test_user_ids()
+        # Parsed neighbor lists, shared by every stage of the run
+        self.neighbor_cache = util.LRUCache(config.NEIGHBOR_CACHE_SIZE)
+        self._user_watches = None
+        self._repo_freqs = None
+        self._repos = None
+        self._test_users = None
+        self._prewarmed = False
+        self._name_index = None
+        self._family_index = None
+        self._language_index = None
+
+    @property
+    def user_watches(self):
+        if self._user_watches is None:
+            self._user_watches = users.get_user_watches()
+        return self._user_watches
+
+    @property
+    def repo_freqs(self):
+        if self._repo_freqs is None:
+            self._repo_freqs = users.get_repo_frequencies()
+        return self._repo_freqs
+
+    @property
+    def repos(self):
+        if self._repos is None:
+            self._repos = repos.get_repos()
+        return self._repos
 
+    @property
+    def test_users(self):
+        if self._test_users is None:
+            self._test_users = users.get_test_user_ids()
+        return self._test_users
 
-    def get_probabilistic_candidates(self, n=10):
+    def load(self):
+        """
+        Loads the datasets and the indexes the configured fill
+        tiers use, and prewarms the neighbor cache, now rather
+        than on first access.
+        """
+        self.user_watches
+        self.repo_freqs
+        self.repos
+        self.test_users
+        self._get_family_index()
+        if set(['similarly_named', 'similarly_named_related']) & set(config.FILL_TIERS):
+            self._get_name_index()
+        if 'languages' in config.FILL_TIERS:
+            self._get_language_index()
+        self.open_reader().close()
+
+
+    def get_probabilistic_candidates(self, n=10, processes=None):
         """
         Gets the top n candidate repos for users in the
-        test file.
+        test file. With more than one process, the test
+        users are sharded across a pool of workers.
         """
         candidates = collections.defaultdict(list)
 
-        db = tokyo.Reader()
+        processes = processes or config.PROCESSES
+        if processes > 1:
+            # Loaded before any workers fork so that they inherit it
+            self.user_watches
+            shards = _shard(self.test_users, config.SCORING_BATCH_SIZE)
+            for shard in self._map_shards(_probabilistic_shard, shards, n, processes):
+                candidates.update(shard)
+            return candidates
+
+        db = self.open_reader()
 
         try:
-            for user in self.test_users:
-                logger.debug("Getting top {0} for user {1}".format(n, user))
-                self._fill_probabilistic(db, candidates[user], self.user_watches[user], n)
-                logger.debug("Gathered {0} candidates for user {1}".format(len(candidates[user]), user))
+            batch_size = config.SCORING_BATCH_SIZE
+            for start in xrange(0, len(self.test_users), batch_size):
+                batch = self.test_users[start:start + batch_size]
+                logger.debug("Getting top {0} for {1} users".format(n, len(batch)))
+                scoring.select_batch(db, [(user, self.user_watches[user]) for user in batch],
+                                     n, candidates)
 
         finally:
             db.close()
@@ -42,87 +121,408 @@ class Analysis:
         return candidates
 
 
-    def fill_candidates(self, candidates, n=10):
-        
-        db = tokyo.Reader()
-        top_repos = sorted([r[0] for r in self.repo_freqs.values()], reverse=True)
+    def fill_candidates(self, candidates, n=10, processes=None):
+        """
+        Fills the candidate lists that have fewer than n repos,
+        in place. With more than one process, the users are
+        sharded across a pool of workers.
+        """
+        # Loaded before any workers fork so that they inherit them
+        self.user_watches
+        self._get_family_index()
+        if 'languages' in config.FILL_TIERS:
+            self._get_language_index()
+
+        processes = processes or config.PROCESSES
+        if processes > 1:
+            shards = _shard(candidates.items(), config.FILL_SHARD_SIZE)
+            for shard in self._map_shards(_fill_shard, shards, n, processes):
+                for user, suggestions in shard:
+                    candidates[user] = suggestions
+            return
+
+        db = self.open_reader()
+
+        try:
+            for batch in _shard(candidates.items(), config.FILL_SHARD_SIZE):
+                self._fill_batch(db, batch, n)
+        finally:
+            db.close()
+
+
+    def iter_candidates(self, users, n=10, processes=None):
+        """
+        Yields a (user, probabilistic candidates, filled candidates)
+        triple for each of the given users, in order. Users are
+        scored and filled a batch of config.SCORING_BATCH_SIZE at a
+        time, so only one batch is held in memory. With more than
+        one process, batches are handed to a pool of workers, at
+        most two per process at a time.
+        """
+        processes = processes or config.PROCESSES
+        shards = _shard(users, config.SCORING_BATCH_SIZE)
+
+        if processes > 1:
+            # Loaded before any workers fork so that they inherit them
+            self.user_watches
+            self._get_family_index()
+            if 'languages' in config.FILL_TIERS:
+                self._get_language_index()
+
+            for shard in self._map_shards(_candidates_shard, shards, n, processes):
+                for triple in shard:
+                    yield triple
+            return
+
+        db = self.open_reader()
+
+        try:
+            for batch in shards:
+                for triple in self._candidates_batch(db, batch, n):
+                    yield triple
+        finally:
+            db.close()
+
+    def _candidates_batch(self, db, batch, n):
+        candidates = scoring.select_batch(db, [(user, self.user_watches[user]) for user in batch], n)
+        filled = [(user, list(candidates[user])) for user in batch]
+        self._fill_batch(db, filled, n)
+        return [(user, candidates[user], suggestions) for user, suggestions in filled]
+
+    def refresh_candidates(self, prob_path, filled_path, repo_ids=(), user_ids=(), n=20):
+        """
+        Recomputes the probabilistic and filled candidates of only
+        the test users a change can affect: those whose candidates
+        were computed from the model row of one of the changed
+        repos, those who were suggested one, and the changed users
+        themselves. Their lists are patched into the stored
+        candidate files, a batch of config.SCORING_BATCH_SIZE users
+        at a time. Returns the number of users recomputed and
+        skipped.
+        """
+        index = self._reverse_index(prob_path, filled_path, n)
+        names = dict((repo_id, self.repos[repo_id].name) for repo_id in repo_ids
+                     if repo_id in self.repos)
+        affected = sorted(index.affected(repo_ids, user_ids, names))
+        skipped = len(index.test_users) - len(affected)
+
+        logger.info("Refreshing {0} of {1} test users".format(len(affected), len(index.test_users)))
+
+        candidates = {}
+        filled = {}
+        db = self.open_reader()
 
         try:
-            for user, suggestions in candidates.iteritems():
-                
-                # Add ancestors and descendents
-                if len(suggestions) < n:
-                    logger.debug("Filling candidates for user {0} with {1} candidates".format(user, len(suggestions)))
+            for batch in _shard(affected, config.SCORING_BATCH_SIZE):
+                for user, prob, suggestions in self._candidates_batch(db, batch, n):
+                    candidates[user] = prob
+                    filled[user] = suggestions
+        finally:
+            db.close()
+
+        util.patch_candidates(prob_path, candidates, n)
+        util.patch_candidates(filled_path, filled, n)
+
+        metrics.count('refresh_recomputed', len(affected))
+        metrics.count('refresh_skipped', skipped)
+        logger.info("Recomputed {0} users, skipped {1}".format(len(affected), skipped))
+
+        return len(affected), skipped
+
+
+    def _reverse_index(self, prob_path, filled_path, n):
+        """
+        Indexes the model rows each test user's candidates were
+        computed from. Every user's come from the rows of their
+        watched repos. Users whose probabilistic candidates were
+        short also went through the fill tiers, which read the
+        rows of their candidates, of the relatives of their
+        watched repos and of the repos named like them.
+        """
+        index = indexes.ReverseIndex(self.test_users, self.user_watches,
+                                     util.iter_candidates(filled_path))
+
+        for user, suggestions in util.iter_candidates(prob_path):
+            if user not in index.test_users or len(suggestions) >= n:
+                continue
+            watched = self.user_watches.get(user, set())
+            if 'related' in config.FILL_TIERS:
+                index.add(user, self._get_family_index().find(watched))
+            if 'similarly_named_related' in config.FILL_TIERS:
+                index.add_tokens(user, self._name_tokens(watched))
+
+        return index
+
+    def recommend(self, db, user, n=10):
+        """
+        Gets the top n probabilistic candidates for a single
+        user and fills them the same way fill_candidates does.
+        """
+        watches = self.user_watches.get(user, set())
+        suggestions = scoring.select_batch(db, [(user, watches)], n)[user]
+        self._fill_batch(db, [(user, suggestions)], n)
+        return suggestions
+
+
+    def _fill_batch(self, db, batch, n):
+        """
+        Fills a batch of (user, suggestions) pairs, in place, with
+        the tiers in config.FILL_TIERS, in order. Each tier only
+        sees the users that are still short. Most tiers fill one
+        user at a time; the 'languages' tier fills all of them at
+        once.
+        """
+        debug = logger.isEnabledFor(logging.DEBUG)
+        # Lists found by one tier and reused by a later one
+        found = dict((user, {}) for user, suggestions in batch)
 
-                    relatives = set()
-                    for w in self.user_watches[user]:
-                        relatives.update(map(operator.attrgetter('id'), self.repos[w].ancestors) + 
-                                         map(operator.attrgetter('id'), self.repos[w].descendents))
+        for tier in config.FILL_TIERS:
+            if tier not in _fill_tiers:
+                raise ValueError("Unknown fill tier {0}".format(tier))
 
+            short = [(user, suggestions) for user, suggestions in batch if len(suggestions) < n]
+            if not short:
+                break
 
-                    logger.debug("Found {0} relatives".format(len(relatives)))
+            filled = sum(len(suggestions) for user, suggestions in short)
 
-                    for r in sorted(relatives, 
-                                    cmp=lambda x,y: cmp(self.repo_freqs[x],
-                                                        self.repo_freqs[y]), reverse=True):
-                        if not r in suggestions:
-                            logger.debug("Adding relative {0}".format(r))
-                            suggestions.append(r)
-                            if len(suggestions) == n:
-                                break
+            if tier in _batch_tiers:
+                getattr(self, _fill_tiers[tier])(short, n)
+            else:
+                for user, suggestions in short:
+                    if debug:
+                        logger.debug("Filling candidates for user {0} with {1} candidates from {2}".format(
+                                user, len(suggestions), tier))
+                    getattr(self, _fill_tiers[tier])(db, user, suggestions, n, found[user])
 
-                if len(suggestions) < n:
-                    # Fill with probabilistic candidates based on relatives
-                    # and current watches (which may have been modified)
-                    relatives.update(suggestions)
+            metrics.count('fill_' + tier, sum(len(suggestions) for user, suggestions in short) - filled)
 
-                    logger.debug("Looking for candidates for {0} relatives".format(len(relatives)))
+    def _fill_relatives(self, db, user, suggestions, n, found):
+        """
+        Adds ancestors and descendants of the watched repos.
+        """
+        debug = logger.isEnabledFor(logging.DEBUG)
+        watched = self.user_watches.get(user, set())
 
-                    self._fill_probabilistic(db, suggestions, relatives, n)
+        # Most popular first, merged from the presorted families
+        relatives = self._get_family_index().find(watched)
+        found['relatives'] = relatives
 
-                if len(suggestions) < n:
-                    logger.debug("Looking for similarly named repos")
+        if debug:
+            logger.debug("Found {0} relatives".format(len(relatives)))
 
-                    # Look for similarly named repos
-                    similar = self._find_similarly_named(self.user_watches[user])
+        for r in relatives:
+            if not r in suggestions and not r in watched:
+                if debug:
+                    logger.debug("Adding relative {0}".format(r))
+                suggestions.append(r)
+                if len(suggestions) == n:
+                    break
+
+    def _fill_related(self, db, user, suggestions, n, found):
+        """
+        Adds probabilistic candidates based on the relatives and
+        the current suggestions (which may have been modified).
+        """
+        if 'relatives' not in found:
+            found['relatives'] = self._get_family_index().find(self.user_watches.get(user, set()))
+        relatives = set(found['relatives'])
+        relatives.update(suggestions)
 
-                    logger.debug("Adding {0} similarly named items".format(len(similar)))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Looking for candidates for {0} relatives".format(len(relatives)))
 
-                    suggestions.extend(similar[:n - len(suggestions)])
+        self._fill_probabilistic(db, suggestions, relatives, n)
 
-                if len(suggestions) < n:
-                    if len(similar) > 0:
-                        self._fill_probabilistic(db, suggestions, similar, n)
+    def _fill_similarly_named(self, db, user, suggestions, n, found):
+        similar = self._find_similarly_named(self.user_watches.get(user, set()))
+        found['similar'] = similar
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Adding {0} similarly named items".format(len(similar)))
+
+        suggestions.extend(similar[:n - len(suggestions)])
+
+    def _fill_similarly_named_related(self, db, user, suggestions, n, found):
+        if 'similar' not in found:
+            found['similar'] = self._find_similarly_named(self.user_watches.get(user, set()))
+        similar = found['similar']
+
+        if len(similar) > 0:
+            self._fill_probabilistic(db, suggestions, similar, n)
+
+    def _fill_languages(self, short, n):
+        """
+        Adds the repos whose languages are closest to those of
+        each user's watched repos, for a whole batch of users.
+        """
+        watched = [self.user_watches.get(user, set()) for user, suggestions in short]
+        exclude = [set(suggestions) for user, suggestions in short]
+        counts = [n - len(suggestions) for user, suggestions in short]
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Looking for repos in the languages of {0} users".format(len(short)))
+
+        nearest = self._get_language_index().nearest(watched, counts, exclude)
+        for (user, suggestions), repo_ids in zip(short, nearest):
+            suggestions.extend(repo_ids)
+
+    def _fill_top_repos(self, db, user, suggestions, n, found):
+        watched = self.user_watches.get(user, set())
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Filling {0} slots with top repos".format(n - len(suggestions)))
+
+        for r in self._get_top_repos():
+            if not r in suggestions and not r in watched:
+                suggestions.append(r)
+                if len(suggestions) == n:
+                    break
+
+    def _map_shards(self, worker, shards, args, processes):
+        """
+        Runs worker over each shard in a pool of processes. Each
+        process opens its own model reader. Results are yielded in
+        shard order, so the output does not depend on scheduling.
+        At most two shards per process are in flight, so results
+        do not pile up when the consumer is slower than the pool.
+        Logs the throughput of each worker at the end.
+        """
+        global _worker_analysis, _worker_args
+        _worker_analysis = self
+        _worker_args = args
+
+        logger.info("Running {0} shards on {1} processes".format(len(shards), processes))
+
+        pool = multiprocessing.Pool(processes, _init_worker)
+        throughput = collections.defaultdict(lambda: [0, 0.0])
+        pending = collections.deque()
+        shards = iter(shards)
+        try:
+            for shard in itertools.islice(shards, processes * 2):
+                pending.append(pool.apply_async(worker, (shard,)))
 
-                if len(suggestions) < n:
-                    logger.debug("Filling {0} slots with top repos".format(n - len(suggestions)))
+            while pending:
+                pid, results, elapsed, counters = pending.popleft().get()
+                for shard in itertools.islice(shards, 1):
+                    pending.append(pool.apply_async(worker, (shard,)))
 
-                    suggestions.extend(top_repos[:n - len(suggestions)])
+                throughput[pid][0] += len(results)
+                throughput[pid][1] += elapsed
+                metrics.merge(counters)
+                yield results
+            pool.close()
+        except:
+            pool.terminate()
+            raise
         finally:
-            db.close()
+            pool.join()
+            _worker_analysis = _worker_args = None
 
+        for pid, (count, elapsed) in sorted(throughput.items()):
+            logger.info("Worker {0}: {1} users in {2:.2f}s ({3:.1f} users/s)".format(
+                    pid, count, elapsed, count / elapsed if elapsed else 0))
 
-    def _fill_probabilistic(self, db, candidates, src_repos, n):
-        related_repos = db.get_related_repos(src_repos)
 
-        self._sort_related_repos(related_repos)
+    def _get_top_repos(self):
+        """
+        Returns every repo id, most watched first.
+        """
+        return self._get_family_index().ranked
+
+    def _get_family_index(self):
+        if self._family_index is None:
+            self._family_index = indexes.get_family_index(self._index_data)
+        return self._family_index
+
+    def _get_language_index(self):
+        if self._language_index is None:
+            self._language_index = indexes.get_language_index(self._index_data)
+        return self._language_index
 
-        while len(candidates) < n and len(related_repos) > 0:
-            candidate = related_repos.pop()
-            if candidate[1] not in candidates:
-                logger.debug("Adding {0}".format(candidate))
-                candidates.append(candidate[1])
+    def _get_name_index(self):
+        if self._name_index is None:
+            self._name_index = indexes.get_name_index(self._index_data)
+        return self._name_index
 
-    def _sort_related_repos(self, related_repos):
-        weight = .15
-        def sort_(x,y):
-            return cmp((1 + weight * math.log(x[2])) * x[3],
-                       (1 + weight * math.log(y[2])) * y[3])
-        related_repos.sort(cmp=sort_)
+    def _index_data(self):
+        # Only loaded when a stored index has to be rebuilt
+        return self.repos, self.repo_freqs
+
+    def open_reader(self):
+        """
+        Opens the model, sharing this analysis's neighbor cache
+        and prewarming it on first use. The caller closes it.
+        """
+        db = _open_reader(self.neighbor_cache)
+        if not self._prewarmed and isinstance(db, tokyo.Reader):
+            db.prewarm()
+            self._prewarmed = True
+        return db
+
+    def _fill_probabilistic(self, db, candidates, src_repos, n):
+        related_repos = db.get_related_repos(src_repos)
+
+        scoring.select(related_repos, candidates, n)
 
     def _find_similarly_named(self, repo_ids):
+        """
+        Finds repos whose names contain a word from the names of
+        the given repos, most popular first.
+        """
+        watched = set(repo_ids)
+        return [r for r in self._get_name_index().find(self._name_tokens(repo_ids)) if r not in watched]
+
+    def _name_tokens(self, repo_ids):
         repo_names = set([self.repos[rid].name for rid in repo_ids])
-        tokens = '|'.join(set(sum([re.findall('[a-z]+', name, re.I) for name in repo_names], [])))
-        similar = sorted([repo.id for repo in self.repos.values() if re.search(tokens, repo.name, re.I)],
-                         cmp=lambda x,y: cmp(self.repo_freqs[x], self.repo_freqs[y]), reverse=True)
-        return list(set(similar) - set(repo_ids))
+        return set(sum([re.findall('[a-z]+', name, re.I) for name in repo_names], []))
+
+
+# Fill tier names and the methods that fill them. Batch tiers
+# fill every short user of a batch in one call.
+_fill_tiers = {
+    'relatives': '_fill_relatives',
+    'related': '_fill_related',
+    'similarly_named': '_fill_similarly_named',
+    'similarly_named_related': '_fill_similarly_named_related',
+    'languages': '_fill_languages',
+    'top_repos': '_fill_top_repos',
+    }
+_batch_tiers = set(['languages'])
+
+# Worker process state. The analysis and the stage arguments are
+# inherited from the parent process when the pool forks; each
+# worker opens its own reader.
+_worker_analysis = None
+_worker_args = None
+_worker_db = None
+
+def _shard(items, size):
+    return [items[start:start + size] for start in xrange(0, len(items), size)]
+
+def _init_worker():
+    global _worker_db
+    _worker_db = _worker_analysis.open_reader()
+
+def _probabilistic_shard(test_users):
+    n = _worker_args
+    start = time.time()
+    metrics.reset()
+    user_watches = _worker_analysis.user_watches
+    candidates = scoring.select_batch(_worker_db, [(user, user_watches[user]) for user in test_users], n)
+    return (os.getpid(), [(user, candidates[user]) for user in test_users],
+            time.time() - start, metrics.counters())
+
+def _candidates_shard(users):
+    n = _worker_args
+    start = time.time()
+    metrics.reset()
+    triples = _worker_analysis._candidates_batch(_worker_db, users, n)
+    return os.getpid(), triples, time.time() - start, metrics.counters()
+
+def _fill_shard(shard):
+    n = _worker_args
+    start = time.time()
+    metrics.reset()
+    _worker_analysis._fill_batch(_worker_db, shard, n)
+    return os.getpid(), shard, time.time() - start, metrics.counters()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+Scaling benchmark of the pipeline on synthetic data.
+
+For each scale, writes a synthetic dataset with synth.py into a
+temporary workspace and runs the stages below on it, each in a
+fresh subprocess so that its peak memory is its own:
+
+  build_model    tokyo.compute_conditional_probabilities, and the
+                 CSR conversion when MODEL_FORMAT is 'csr'
+  lineage        repos._set_lineage over every repo
+  related_repos  Reader.get_related_repos for every test user
+  candidates     the top 20 probabilistic candidates
+  fill           Analysis.fill_candidates
+
+Records the time, peak memory and users per second of each
+stage, and the size of the model on disk, logs a table of them
+and appends everything as one JSON line to a results file.
+"""
+
+from __future__ import division
+import analyzers
+import config
+import csr
+import logging
+import metrics
+import optparse
+import os
+import os.path
+import repos
+import shutil
+import simplejson as json
+import subprocess
+import sys
+import synth
+import tempfile
+import time
+import tokyo
+import util
+
+logger = logging.getLogger("ghc.benchmark")
+
+stages = ['build_model', 'lineage', 'related_repos', 'candidates', 'fill']
+
+def benchmark(scales=(1, 10, 100), seed=0, out_path='benchmark.jsonl', keep=False,
+              stage_names=None):
+    """
+    Runs the stages at each scale and appends the results to
+    out_path. A stage that fails ends its scale, the later
+    stages depend on its output. Returns the results dict.
+    """
+    stage_names = stage_names or stages
+    runs = []
+
+    for scale in scales:
+        work_dir = tempfile.mkdtemp(prefix='ghc-bench-')
+        logger.info("Scale {0} in {1}".format(scale, work_dir))
+
+        try:
+            for name in ('calculated', 'logging'):
+                os.mkdir(os.path.join(work_dir, name))
+
+            start = time.time()
+            counts = synth.generate(os.path.join(work_dir, 'raw_data'), scale, seed)
+            run = {'scale': scale, 'data': counts, 'generate_seconds': time.time() - start,
+                   'stages': []}
+            runs.append(run)
+
+            for stage in stage_names:
+                result = _run_child(stage, work_dir)
+                run['stages'].append(result)
+                if 'error' in result:
+                    logger.error("{0} failed at scale {1}: {2}".format(stage, scale, result['error']))
+                    break
+                if stage == 'build_model':
+                    run['model_bytes'] = _model_bytes(work_dir)
+        finally:
+            if keep:
+                logger.info("Kept workspace {0}".format(work_dir))
+            else:
+                shutil.rmtree(work_dir)
+
+    results = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'seed': seed,
+        'config': {'MODEL_ENGINE': config.MODEL_ENGINE,
+                   'MODEL_FORMAT': config.MODEL_FORMAT,
+                   'PROCESSES': config.PROCESSES,
+                   'MODEL_TOP_K': config.MODEL_TOP_K,
+                   'HEAVY_WATCHER_POLICY': config.HEAVY_WATCHER_POLICY},
+        'runs': runs,
+        }
+
+    out = open(out_path, 'a')
+    try:
+        out.write("{0}\n".format(json.dumps(results, sort_keys=True)))
+    finally:
+        out.close()
+
+    _log_table(runs)
+
+    return results
+
+def _run_child(stage, work_dir):
+    """
+    Runs one stage in a subprocess in work_dir, which the
+    relative data paths of config resolve against. Returns the
+    dict the child prints, or one with the error.
+    """
+    env = dict(os.environ)
+    here = os.path.dirname(os.path.abspath(__file__))
+    env['PYTHONPATH'] = os.pathsep.join([here] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    logger.info("Running {0}".format(stage))
+    child = subprocess.Popen([sys.executable, os.path.join(here, 'benchmark.py'), '--stage', stage],
+                             cwd=work_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = child.communicate()
+
+    if child.returncode != 0:
+        lines = errors.strip().splitlines()
+        return {'name': stage, 'error': lines[-1] if lines else "exit {0}".format(child.returncode)}
+    return json.loads(output.strip().splitlines()[-1])
+
+def run_stage(stage):
+    """
+    Runs one stage on the data under the current directory and
+    returns its name, seconds, peak memory and users per second.
+    Loading the data a stage needs is not timed.
+    """
+    users = 0
+
+    if stage == 'build_model':
+        with metrics.timed(stage) as timer:
+            tokyo.compute_conditional_probabilities()
+            if config.MODEL_FORMAT == 'csr':
+                csr.convert_tokyo()
+
+    elif stage == 'lineage':
+        store = repos.get_repos()
+        with metrics.timed(stage) as timer:
+            repos._set_lineage(store)
+
+    elif stage == 'related_repos':
+        analysis = analyzers.Analysis()
+        test_users = analysis.test_users
+        user_watches = analysis.user_watches
+        db = analysis.open_reader()
+        try:
+            with metrics.timed(stage) as timer:
+                for user in test_users:
+                    db.get_related_repos(user_watches[user])
+        finally:
+            db.close()
+        users = len(test_users)
+
+    elif stage == 'candidates':
+        analysis = analyzers.Analysis()
+        analysis.user_watches
+        with metrics.timed(stage) as timer:
+            candidates = analysis.get_probabilistic_candidates(20)
+        util.write_candidates(candidates, _prob_path(), 20, config.CANDIDATE_FORMAT)
+        users = len(candidates)
+
+    elif stage == 'fill':
+        analysis = analyzers.Analysis()
+        candidates = util.read_candidates(_prob_path())
+        analysis.user_watches
+        analysis.repos
+        with metrics.timed(stage) as timer:
+            analysis.fill_candidates(candidates, 20)
+        users = len(candidates)
+
+    else:
+        raise ValueError("Unknown stage {0}".format(stage))
+
+    return {'name': stage, 'seconds': timer.seconds,
+            'peak_memory_kb': metrics.peak_memory(),
+            'users_per_second': users / timer.seconds if users and timer.seconds else 0}
+
+def _prob_path():
+    return 'results-prob-20' + ('.bin' if config.CANDIDATE_FORMAT == 'binary' else '.txt')
+
+def _model_bytes(work_dir):
+    paths = [tokyo.database_path()]
+    if config.MODEL_FORMAT == 'csr':
+        paths.append(csr.database_path())
+    paths = [os.path.join(work_dir, path) for path in paths]
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+def _log_table(runs):
+    logger.info("{0:>8} {1:>10} {2:<14} {3:>10} {4:>12} {5:>10}".format(
+            'scale', 'watches', 'stage', 'seconds', 'peak KB', 'users/s'))
+    for run in runs:
+        for stage in run['stages']:
+            if 'error' in stage:
+                logger.info("{0:>8} {1:>10} {2:<14} failed: {3}".format(
+                        run['scale'], run['data']['watches'], stage['name'], stage['error']))
+                continue
+            logger.info("{0:>8} {1:>10} {2[name]:<14} {2[seconds]:>10.2f} {2[peak_memory_kb]:>12} "
+                        "{2[users_per_second]:>10.1f}".format(run['scale'], run['data']['watches'], stage))
+        if 'model_bytes' in run:
+            logger.info("{0:>8} model size {1:.1f} MB".format(run['scale'], run['model_bytes'] / (1024 * 1024)))
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-x', '--scales', default='1,10,100',
+                      help="comma separated sizes relative to the 2009 dump")
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help="seed for the synthetic data")
+    parser.add_option('-t', '--stages', default=','.join(stages),
+                      help="comma separated stages to run, in order")
+    parser.add_option('-o', '--out', default='benchmark.jsonl',
+                      help="file to append the results to")
+    parser.add_option('-k', '--keep', action='store_true', default=False,
+                      help="keep the temporary workspaces")
+    parser.add_option('--stage', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.stage:
+        # Child process: quiet, with the result on stdout
+        logging.basicConfig(level=logging.WARNING)
+        print json.dumps(run_stage(options.stage))
+        return
+
+    stage_names = [name for name in options.stages.split(',') if name]
+    for name in stage_names:
+        if name not in stages:
+            parser.error("Unknown stage {0}".format(name))
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    benchmark([float(scale) for scale in options.scales.split(',')],
+              options.seed, options.out, options.keep, stage_names)
+
+if __name__ == '__main__':
+    main()
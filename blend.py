@@ -0,0 +1,71 @@
+"""
+Blends unwatched ancestor sources into the candidate lists.
+
+Users who watch forks are likely to watch the repos those forks
+came from. For every user, the ancestors of their watched repos
+that they do not watch yet are put ahead of the other candidates.
+"""
+
+from __future__ import division
+import config
+import logging
+import repos
+import users
+import util
+
+logger = logging.getLogger("ghc.blend")
+
+def get_unwatched_sources(user, user_watches, repo_map, repo_freqs):
+    """
+    Returns the ancestors of the user's watched repos that the
+    user does not watch, most popular first.
+    """
+    watched = user_watches.get(user, ())
+    sources = set()
+    for w in watched:
+        if w in repo_map:
+            sources.update(a.id for a in repo_map[w].ancestors if a.id not in watched)
+
+    def popularity(repo_id):
+        return -repo_freqs[repo_id][0] if repo_id in repo_freqs else 0, repo_id
+
+    return sorted(sources, key=popularity)
+
+def blend(suggestions, sources, n=10, count=None):
+    """
+    Puts the first count sources ahead of the suggestions
+    and keeps the first n repos.
+    """
+    count = config.BLEND_SOURCES if count is None else count
+    first = sources[:count]
+    taken = set(first)
+    return (first + [s for s in suggestions if s not in taken])[:n]
+
+def blend_candidates(candidates, n=10, count=None):
+    """
+    Blends an iterable of (user, suggestions) pairs, yielding
+    (user, blended) pairs. Sources are looked up by user id.
+    """
+    user_watches = users.get_user_watches()
+    repo_freqs = users.get_repo_frequencies()
+    repo_map = repos.get_repos()
+
+    for user, suggestions in candidates:
+        sources = get_unwatched_sources(user, user_watches, repo_map, repo_freqs)
+        yield user, blend(suggestions, sources, n, count)
+
+def blend_file(in_path, out_path, n=10, count=None):
+    """
+    Blends a text or binary candidates file into a text
+    results file in one streaming pass, one user at a time.
+    """
+    logger.debug("Blending {0} into {1}".format(in_path, out_path))
+
+    out = open(out_path, 'w')
+    try:
+        for user, blended in blend_candidates(util.iter_candidates(in_path), n, count):
+            out.write("{0}:{1}\n".format(user, ",".join(map(str, blended))))
+    finally:
+        out.close()
+
+    logger.debug("Wrote {0}".format(out_path))
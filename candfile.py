@@ -0,0 +1,176 @@
+import array
+import logging
+import mmap
+import struct
+import sys
+
+logger = logging.getLogger("ghc.candfile")
+
+# Binary candidate file layout, all little endian:
+#
+#   header   magic, slots per user (n), number of users
+#   users    int32 user ids, sorted
+#   rows     one row per user in the same order: an int32 count
+#            followed by n int32 repo id slots, unused slots are -1
+#
+# Rows have a fixed width, so a user's list is found from its
+# position in the user index without reading anything else,
+# and can be rewritten in place.
+_magic = 'CND1'
+_header = struct.Struct('<4sII')
+_int = struct.Struct('<i')
+
+def is_binary(path):
+    f = open(path, 'rb')
+    try:
+        return f.read(len(_magic)) == _magic
+    finally:
+        f.close()
+
+def write(candidates, path, n):
+    """
+    Writes a {user: [repo ids]} dict, or (user, [repo ids])
+    pairs, keeping the first n repos of each list.
+    """
+    if hasattr(candidates, 'iteritems'):
+        candidates = candidates.iteritems()
+    candidates = sorted(candidates)
+
+    users = array.array('i', [user for user, suggestions in candidates])
+    rows = array.array('i', [-1]) * ((n + 1) * len(candidates))
+    for k, (user, suggestions) in enumerate(candidates):
+        suggestions = suggestions[:n]
+        start = k * (n + 1)
+        rows[start] = len(suggestions)
+        rows[start + 1:start + 1 + len(suggestions)] = array.array('i', suggestions)
+
+    out = open(path, 'wb')
+
+    try:
+        out.write(_header.pack(_magic, n, len(users)))
+        for values in (users, rows):
+            if sys.byteorder != 'little':
+                values.byteswap()
+            values.tofile(out)
+    finally:
+        out.close()
+
+    logger.debug("Wrote candidates for {0} users to {1}".format(len(users), path))
+
+def create(path, users, n):
+    """
+    Writes a file holding an empty list for each of the users,
+    to be filled in place with Reader(path, writable=True).put.
+    """
+    write([(user, []) for user in users], path, n)
+
+def from_text(text_path, path, n=None):
+    """
+    Converts a 'user:repo,repo,...' text file. n defaults
+    to the length of the longest list.
+    """
+    candidates = list(_read_text(text_path))
+    if n is None:
+        n = max([len(suggestions) for user, suggestions in candidates] or [0])
+    write(candidates, path, n)
+
+def to_text(path, text_path):
+    reader = Reader(path)
+    out = open(text_path, 'w')
+
+    try:
+        for user, suggestions in reader.iteritems():
+            out.write("{0}:{1}\n".format(user, ",".join(map(str, suggestions))))
+    finally:
+        out.close()
+        reader.close()
+
+def _read_text(text_path):
+    for line in open(text_path, 'r'):
+        user, repos = line.rstrip().split(':')
+        yield int(user), [int(r) for r in repos.split(',')] if repos else []
+
+
+class Reader:
+    """
+    Memory-mapped view of a binary candidate file. Looks up a
+    single user's list with a binary search of the user index,
+    or streams every list in user order. Opened writable, the
+    lists of the users in the file can be replaced in place.
+    """
+    def __init__(self, path, writable=False):
+        self.file = open(path, 'r+b' if writable else 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0,
+                             access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+        magic, self.n, self.count = _header.unpack_from(self.map, 0)
+        if magic != _magic:
+            self.close()
+            raise IOError("{0} is not a binary candidate file".format(path))
+
+        self._users = _header.size
+        self._rows = self._users + 4 * self.count
+        self._row = struct.Struct('<{0}i'.format(self.n + 1))
+
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, user):
+        return self._position(user) is not None
+
+    def __iter__(self):
+        return self.users()
+
+    def get(self, user, default=None):
+        position = self._position(user)
+        if position is None:
+            return default
+        return self._read_row(position)
+
+    def users(self):
+        for position in xrange(self.count):
+            yield self._user(position)
+
+    def iteritems(self):
+        for position in xrange(self.count):
+            yield self._user(position), self._read_row(position)
+
+
+    def put(self, user, suggestions):
+        """
+        Replaces the list of a user already in the file with the
+        first n repos of suggestions.
+        """
+        position = self._position(user)
+        if position is None:
+            raise KeyError(user)
+
+        suggestions = suggestions[:self.n]
+        row = [len(suggestions)] + list(suggestions) + [-1] * (self.n - len(suggestions))
+        self._row.pack_into(self.map, self._rows + self._row.size * position, *row)
+
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+    def _user(self, position):
+        return _int.unpack_from(self.map, self._users + 4 * position)[0]
+
+    def _read_row(self, position):
+        row = self._row.unpack_from(self.map, self._rows + self._row.size * position)
+        return list(row[1:1 + row[0]])
+
+    def _position(self, user):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._user(mid) < user:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._user(lo) == user:
+            return lo
+        return None
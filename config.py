@@ -3,4 +3,84 @@ SRC_DATA_PATH = "./raw_data"
 CALC_DATA_PATH = "./calculated"
 LOG_PATH = "./logging"
 
+# Write readable JSON copies of the cached data structures
+DEBUG_DUMPS = False
 
+# Level of the run log. Per candidate and per watchlist
+# messages are only formatted at DEBUG.
+LOG_LEVEL = "INFO"
+
+# Engine used by tokyo.compute_conditional_probabilities.
+# 'python' walks every watchlist pair by pair, 'sparse' uses
+# NumPy/SciPy sparse matrix products and 'external' spills
+# sorted runs to CALC_DATA_PATH and merges them.
+MODEL_ENGINE = "python"
+
+# Approximate memory ceiling, in megabytes, for the pair counts
+# the 'external' engine holds before spilling a run to disk.
+MODEL_BUILD_MEMORY_MB = 512
+
+# Pairs with a lower conditional probability are not stored in
+# the model, and with MODEL_TOP_K only that many neighbors of
+# each repo are kept, the highest by scoring.weight. None keeps
+# every neighbor above MODEL_EPSILON; an epsilon of 0 keeps
+# every pair.
+MODEL_EPSILON = 0.001
+MODEL_TOP_K = None
+
+# What the model build does with watchlists longer than
+# HEAVY_WATCHER_LIMIT, which generate most of the pairs.
+# 'cap' keeps their most watched repos, 'sample' a random
+# sample seeded with HEAVY_WATCHER_SEED, and 'weight' counts
+# their watches for HEAVY_WATCHER_LIMIT / len(watchlist).
+# None counts every pair. Repo frequencies follow the policy.
+HEAVY_WATCHER_POLICY = None
+HEAVY_WATCHER_LIMIT = 500
+HEAVY_WATCHER_SEED = 0
+
+# Format of the model read by analyzers. 'tokyo' reads the
+# cprob.tch B-Tree, 'csr' reads cprob.csr, a memory-mapped
+# conversion of it.
+MODEL_FORMAT = "tokyo"
+
+# Number of parsed neighbor lists tokyo.Reader keeps in its
+# LRU cache, and how many of the most watched repos to load
+# into it up front.
+NEIGHBOR_CACHE_SIZE = 10000
+NEIGHBOR_CACHE_PREWARM = 0
+
+# Number of test users scored together by
+# Analysis.get_probabilistic_candidates.
+SCORING_BATCH_SIZE = 500
+
+# Number of worker processes used to generate and fill
+# candidates, and how many users the fill stage fills together
+# and hands a worker at a time. 1 runs everything in this
+# process.
+PROCESSES = 1
+FILL_SHARD_SIZE = 100
+
+# The tiers that fill short candidate lists, in order. Each
+# one only runs for users who are still short after the ones
+# before it. 'languages' adds the repos closest to the user's
+# language profile and needs NumPy.
+FILL_TIERS = ['relatives', 'related', 'similarly_named',
+              'similarly_named_related', 'top_repos']
+
+# Address the recommendation server listens on
+SERVER_HOST = "localhost"
+SERVER_PORT = 8009
+
+# Number of unwatched ancestor sources the blend stage puts
+# ahead of the candidates
+BLEND_SOURCES = 5
+
+# Format of the intermediate 20 candidate files written between
+# stages. 'binary' files are indexed by user id and can be read
+# without parsing; 'text' files are 'user:repo,repo,...' lines.
+CANDIDATE_FORMAT = "binary"
+
+# Whether the stream command also writes the 20 candidate files
+# as it goes, so the fill and blend stages can be rerun on their
+# own afterwards
+STREAM_CHECKPOINTS = False
@@ -0,0 +1,161 @@
+import array
+import config
+import logging
+import metrics
+import mmap
+import os.path
+import pytc
+import scoring
+import struct
+import sys
+import util
+
+logger = logging.getLogger("ghc.csr")
+
+# File layout, all little endian:
+#
+#   header     magic, number of rows, number of pairs
+#   indptr     (rows + 1) uint64 offsets; the neighbors of repo i
+#              are stored at [indptr[i], indptr[i + 1])
+#   neighbors  int32 related repo ids
+#   cofreqs    int32 cofrequencies
+#   probs      float64 conditional probabilities
+#
+# Within a row, neighbors keep the key order of cprob.tch so that
+# readers return related repos in the same order as tokyo.Reader.
+_magic = 'CSR1'
+_header = struct.Struct('<4sIQ')
+
+def database_path():
+    return os.path.join(config.CALC_DATA_PATH, 'cprob.csr')
+
+def database_exists():
+    return os.path.exists(database_path())
+
+def convert_tokyo(tokyo_path=None, path=None):
+    """
+    Converts the 'i,j' -> 'cofreq,prob' records of cprob.tch
+    into the CSR format. Makes two passes over the B-Tree, one
+    to size each row and one to fill the arrays.
+    """
+    tokyo_path = tokyo_path or os.path.join(config.CALC_DATA_PATH, 'cprob.tch')
+    path = path or database_path()
+
+    db = pytc.BDB()
+    db.open(tokyo_path, pytc.BDBOREADER)
+
+    logger.debug("Converting {0} to {1}".format(tokyo_path, path))
+
+    try:
+        row_sizes = {}
+        for key in db.iterkeys():
+            i = int(key.split(',')[0])
+            row_sizes[i] = row_sizes.get(i, 0) + 1
+
+        rows = max(row_sizes) + 1 if row_sizes else 0
+        indptr = [0] * (rows + 1)
+        for i in xrange(rows):
+            indptr[i + 1] = indptr[i] + row_sizes.get(i, 0)
+        nnz = indptr[rows]
+
+        neighbors = array.array('i', [0]) * nnz
+        cofreqs = array.array('i', [0]) * nnz
+        probs = array.array('d', [0.0]) * nnz
+
+        # Next free slot of each row
+        fill = dict((i, indptr[i]) for i in row_sizes)
+
+        for key, value in db.iteritems():
+            i, j = key.split(',')
+            cofreq, prob = value.split(',')
+            i = int(i)
+            slot = fill[i]
+            neighbors[slot] = int(j)
+            cofreqs[slot] = int(cofreq)
+            probs[slot] = float(prob)
+            fill[i] = slot + 1
+
+    finally:
+        db.close()
+
+    _write(path, indptr, neighbors, cofreqs, probs)
+
+def _write(path, indptr, neighbors, cofreqs, probs):
+    rows = len(indptr) - 1
+    nnz = len(neighbors)
+
+    out = open(path, 'wb')
+
+    try:
+        out.write(_header.pack(_magic, rows, nnz))
+        out.write(struct.pack('<{0}Q'.format(rows + 1), *indptr))
+        for values in (neighbors, cofreqs, probs):
+            if sys.byteorder != 'little':
+                values = array.array(values.typecode, values)
+                values.byteswap()
+            values.tofile(out)
+    finally:
+        out.close()
+
+    logger.debug("Wrote {0} pairs for {1} repos to {2}".format(nnz, rows, path))
+
+
+class Reader:
+    """
+    Read-only, memory-mapped view of a CSR model with the same
+    interface as tokyo.Reader. Rows read out of the mapped arrays
+    are kept in an LRU cache keyed by repo id, which can be
+    shared with other readers.
+    """
+    def __init__(self, path=None, cache=None):
+        path = path or database_path()
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.cache = cache if cache is not None else util.LRUCache(config.NEIGHBOR_CACHE_SIZE)
+
+        magic, self.rows, self.nnz = _header.unpack_from(self.map, 0)
+        if magic != _magic:
+            self.close()
+            raise IOError("{0} is not a CSR model".format(path))
+
+        self._indptr = _header.size
+        self._neighbors = self._indptr + 8 * (self.rows + 1)
+        self._cofreqs = self._neighbors + 4 * self.nnz
+        self._probs = self._cofreqs + 4 * self.nnz
+
+
+    def get_neighbors(self, repo):
+        """
+        Returns the (related_repo_id, cofrequency, conditional_probability)
+        tuples stored for a repo.
+        """
+        return scoring.cached_neighbors(self.cache, repo, self._read_neighbors)
+
+
+    def _read_neighbors(self, repo):
+        metrics.count('db_lookups')
+        if repo < 0 or repo >= self.rows:
+            return []
+
+        start, end = struct.unpack_from('<2Q', self.map, self._indptr + 8 * repo)
+        count = end - start
+        if not count:
+            return []
+
+        return zip(struct.unpack_from('<{0}i'.format(count), self.map, self._neighbors + 4 * start),
+                   struct.unpack_from('<{0}i'.format(count), self.map, self._cofreqs + 4 * start),
+                   struct.unpack_from('<{0}d'.format(count), self.map, self._probs + 8 * start))
+
+
+    def get_related_repos(self, user_watches):
+        """
+        Returns a list of tuples:
+        (watch, related_repo_id, cofrequency, conditional_probability)
+        """
+        return scoring.related_repos(self, user_watches)
+
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+        logger.debug("Neighbor cache: {0} hits, {1} misses".format(self.cache.hits, self.cache.misses))
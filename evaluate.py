@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+Offline evaluation of the recommendation pipeline.
+
+Holds out one watch for each of a sample of users, runs the
+model build, probabilistic, fill and blend stages on the
+remaining data and measures how often the held out repo makes
+the top 10. Also records wall time, growth of the memory
+high-water mark and users per second for each stage, and
+appends everything as one JSON line to a results file so runs
+can be compared.
+"""
+
+from __future__ import division
+import analyzers
+import blend
+import config
+import csr
+import indexes
+import ingest
+import logging
+import metrics
+import optparse
+import os
+import os.path
+import random
+import shutil
+import simplejson as json
+import tempfile
+import time
+import tokyo
+import users
+
+logger = logging.getLogger("ghc.evaluate")
+
+def evaluate(sample_size=1000, seed=0, n=20, out_path='evaluation.jsonl', keep=False):
+    """
+    Runs one evaluation and appends its results to out_path.
+    Returns the results dict.
+    """
+    held_out, watches = _hold_out(sample_size, seed)
+
+    work_dir = tempfile.mkdtemp(prefix='ghc-eval-')
+    saved_paths = config.SRC_DATA_PATH, config.CALC_DATA_PATH
+
+    logger.info("Evaluating {0} users in {1}".format(len(held_out), work_dir))
+
+    try:
+        _write_workspace(work_dir, held_out, watches)
+        config.SRC_DATA_PATH = os.path.join(work_dir, 'raw_data')
+        config.CALC_DATA_PATH = os.path.join(work_dir, 'calculated')
+        _reset_caches()
+
+        stages = []
+
+        with metrics.timed('build_model') as timer:
+            tokyo.compute_conditional_probabilities()
+            if config.MODEL_FORMAT == 'csr':
+                csr.convert_tokyo()
+        stages.append(_stage(timer))
+
+        with metrics.timed('load') as timer:
+            analysis = analyzers.Analysis()
+            analysis.load()
+        stages.append(_stage(timer))
+
+        with metrics.timed('probabilistic') as timer:
+            candidates = analysis.get_probabilistic_candidates(n)
+        stages.append(_stage(timer, len(held_out)))
+        prob_hits = _hits(candidates, held_out)
+        candidates = dict((user, list(suggestions)) for user, suggestions in candidates.iteritems())
+
+        with metrics.timed('fill') as timer:
+            analysis.fill_candidates(candidates, n)
+        stages.append(_stage(timer, len(held_out)))
+        fill_hits = _hits(candidates, held_out)
+
+        with metrics.timed('blend') as timer:
+            blended = dict(blend.blend_candidates(candidates.iteritems()))
+        stages.append(_stage(timer, len(held_out)))
+        blend_hits = _hits(blended, held_out)
+
+    finally:
+        config.SRC_DATA_PATH, config.CALC_DATA_PATH = saved_paths
+        _reset_caches()
+        if keep:
+            logger.info("Kept workspace {0}".format(work_dir))
+        else:
+            shutil.rmtree(work_dir)
+
+    results = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'users': len(held_out),
+        'seed': seed,
+        'n': n,
+        'config': {'MODEL_ENGINE': config.MODEL_ENGINE,
+                   'MODEL_FORMAT': config.MODEL_FORMAT,
+                   'PROCESSES': config.PROCESSES,
+                   'MODEL_TOP_K': config.MODEL_TOP_K,
+                   'HEAVY_WATCHER_POLICY': config.HEAVY_WATCHER_POLICY},
+        'hit_at_10': {'probabilistic': prob_hits / len(held_out),
+                      'fill': fill_hits / len(held_out),
+                      'blend': blend_hits / len(held_out)},
+        'stages': stages,
+        }
+
+    out = open(out_path, 'a')
+    try:
+        out.write("{0}\n".format(json.dumps(results, sort_keys=True)))
+    finally:
+        out.close()
+
+    for stage in stages:
+        logger.info("{0[name]}: {0[seconds]:.2f}s, high-water growth {0[peak_memory_growth_kb]} KB, {0[users_per_second]:.1f} users/s".format(stage))
+    logger.info("hit@10: {0[probabilistic]:.4f} probabilistic, {0[fill]:.4f} fill, {0[blend]:.4f} blend".format(results['hit_at_10']))
+
+    return results
+
+def _hold_out(sample_size, seed):
+    """
+    Picks up to sample_size users with at least two watches and
+    one watch of each to hold out. Returns a dict of user ->
+    held out repo and the full dict of user -> watches.
+    """
+    watches = ingest.group_watches(*ingest.read_watches())
+
+    rng = random.Random(seed)
+    eligible = sorted(user for user, repos in watches.iteritems() if len(repos) > 1)
+    sample = rng.sample(eligible, min(sample_size, len(eligible)))
+
+    return dict((user, rng.choice(sorted(watches[user]))) for user in sample), watches
+
+def _write_workspace(work_dir, held_out, watches):
+    raw_dir = os.path.join(work_dir, 'raw_data')
+    os.mkdir(raw_dir)
+    os.mkdir(os.path.join(work_dir, 'calculated'))
+
+    for name in ('repos.txt', 'lang.txt'):
+        shutil.copy(os.path.join(config.SRC_DATA_PATH, name), raw_dir)
+
+    data = open(os.path.join(raw_dir, 'data.txt'), 'w')
+    try:
+        for user in sorted(watches):
+            for repo in sorted(watches[user]):
+                if held_out.get(user) != repo:
+                    data.write("{0}:{1}\n".format(user, repo))
+    finally:
+        data.close()
+
+    test = open(os.path.join(raw_dir, 'test.txt'), 'w')
+    try:
+        for user in sorted(held_out):
+            test.write("{0}\n".format(user))
+    finally:
+        test.close()
+
+def _reset_caches():
+    users._user_watches = None
+    users._repo_freqs = None
+    users._model_freqs = None
+    users._repo_watchers = None
+    users._model_watches = None
+    users._watch_weights = None
+    users._test_ids = None
+    indexes._name_index = None
+    indexes._family_index = None
+    indexes._language_index = None
+
+def _hits(candidates, held_out):
+    return sum(1 for user, repo in held_out.iteritems()
+               if repo in candidates.get(user, [])[:10])
+
+def _stage(timer, users=0):
+    """
+    The record of a stage timed with metrics.timed. Stages share
+    one process, so memory is the growth of the high-water mark
+    during the stage rather than its own peak.
+    """
+    return {
+        'name': timer.stage,
+        'seconds': timer.seconds,
+        'peak_memory_growth_kb': timer.memory_growth_kb,
+        'users_per_second': users / timer.seconds if users and timer.seconds else 0,
+        }
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-u', '--users', type='int', default=1000,
+                      help="number of users to hold a watch out for")
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help="seed for sampling users and held out watches")
+    parser.add_option('-n', type='int', default=20,
+                      help="candidates to generate per user")
+    parser.add_option('-o', '--out', default='evaluation.jsonl',
+                      help="file to append the results to")
+    parser.add_option('-k', '--keep', action='store_true', default=False,
+                      help="keep the temporary workspace")
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    evaluate(options.users, options.seed, options.n, options.out, options.keep)
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,304 @@
 #!/usr/bin/env python
+"""
+Runs the recommendation pipeline, or a single stage of it:
+
+  build-model  computes the conditional probability model
+  candidates   writes the top 20 probabilistic candidates
+               of each test user
+  fill         fills the candidate lists that are short
+  blend        blends in unwatched sources, writing results.txt
+  all          runs every stage whose output is missing or older
+               than its inputs
+  stream       runs each test user through every stage in turn,
+               appending to results.txt as users finish
+  refresh      applies new watches (--watches) and recomputes the
+               candidates of only the users they affect
+
+A single stage always runs, replacing its output. Data is only
+loaded when a stage first needs it.
+"""
 
 from __future__ import division
 import analyzers
-import collections
+import blend
+import candfile
 import config
+import csr
+import ingest
 import logging
+import metrics
+import optparse
+import os
 import os.path
 import tokyo
 import util
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s %(levelname)s %(message)s',
-                    filename=os.path.join(config.LOG_PATH, 'log.txt'),
-                    filemode='w')
 logger = logging.getLogger('ghc')
 
+results = 'results.txt'
+
+def _candidates_path(stage):
+    extension = '.bin' if config.CANDIDATE_FORMAT == 'binary' else '.txt'
+    return 'results-{0}-20{1}'.format(stage, extension)
+
+def _sources(stage):
+    """
+    The files the output of a stage is built from. They are
+    recorded in the output's manifest, so that a stage reruns
+    once they change.
+    """
+    if stage == 'prob':
+        return [tokyo.database_path(), ingest.data_path(), ingest.test_path()]
+    if stage == 'filled':
+        return [_candidates_path('prob'), ingest.data_path(), ingest.repos_path(), ingest.lang_path()]
+    if stage == 'results':
+        return [_candidates_path('filled'), ingest.data_path(), ingest.repos_path()]
+    # The stream writes results.txt straight from the model
+    return [tokyo.database_path(), ingest.data_path(), ingest.test_path(),
+            ingest.repos_path(), ingest.lang_path()]
+
+def build_model(analysis=None):
+    for path in (tokyo.database_path(), csr.database_path()):
+        if os.path.exists(path):
+            logger.debug("Removing {0}".format(path))
+            os.remove(path)
+
+    with metrics.timed('build_model'):
+        tokyo.compute_conditional_probabilities()
+
+    if config.MODEL_FORMAT == 'csr':
+        convert_model()
+
+def convert_model(analysis=None):
+    with metrics.timed('convert_model'):
+        csr.convert_tokyo()
+
+def probabilistic(analysis=None):
+    analysis = analysis or analyzers.Analysis()
+    with metrics.timed('probabilistic'):
+        candidates = analysis.get_probabilistic_candidates(20)
+        util.write_candidates(candidates, _candidates_path('prob'), 20,
+                              config.CANDIDATE_FORMAT)
+    util.write_manifest(_candidates_path('prob'), _sources('prob'))
+
+def fill(analysis=None):
+    analysis = analysis or analyzers.Analysis()
+    with metrics.timed('fill'):
+        candidates = util.read_candidates(_candidates_path('prob'))
+        analysis.fill_candidates(candidates, 20)
+        util.write_candidates(candidates, _candidates_path('filled'), 20,
+                              config.CANDIDATE_FORMAT)
+    util.write_manifest(_candidates_path('filled'), _sources('filled'))
+
+def blend_results(analysis=None):
+    with metrics.timed('blend'):
+        blend.blend_file(_candidates_path('filled'), results, 10)
+    util.write_manifest(results, _sources('results'))
+
+def run_all(analysis=None):
+    """
+    Runs every stage whose output is missing or was not built
+    from the current contents of its inputs, sharing one
+    Analysis between them.
+    """
+    analysis = analysis or analyzers.Analysis()
+
+    if not tokyo.database_is_fresh():
+        logger.debug("{0} is missing or stale, building...".format(tokyo.database_path()))
+        build_model()
+
+    if config.MODEL_FORMAT == 'csr' and not csr.database_exists():
+        convert_model()
+
+    if not util.is_fresh(_candidates_path('prob'), _sources('prob')):
+        logger.debug("{0} is missing or stale, computing...".format(_candidates_path('prob')))
+        probabilistic(analysis)
+
+    if not util.is_fresh(_candidates_path('filled'), _sources('filled')):
+        fill(analysis)
+
+    if not util.is_fresh(results, _sources('results')):
+        blend_results(analysis)
+
+def stream(analysis=None, checkpoints=None, resume=True):
+    """
+    Runs each test user through the candidates, fill and blend
+    stages without waiting for the other users, appending each
+    result line to results.txt as soon as it is ready. With
+    checkpoints, the 20 candidate files are written along the
+    way. With resume, users already in results.txt are skipped,
+    if it was left by a stream over the current inputs.
+    """
+    if checkpoints is None:
+        checkpoints = config.STREAM_CHECKPOINTS
+
+    if not tokyo.database_is_fresh():
+        build_model()
+
+    if config.MODEL_FORMAT == 'csr' and not csr.database_exists():
+        convert_model()
+
+    analysis = analysis or analyzers.Analysis()
+    test_users = sorted(analysis.test_users)
+    done = set()
+    if resume and util.is_fresh(results, _sources('stream')):
+        done = _finished_users(results)
+    else:
+        # Recorded up front, so that an interrupted run resumes
+        util.write_manifest(results, _sources('stream'))
+    todo = [user for user in test_users if user not in done]
+
+    logger.info("Streaming {0} test users, {1} already done".format(len(todo), len(done)))
+
+    with metrics.timed('stream'):
+        triples = analysis.iter_candidates(todo, 20)
+        if checkpoints:
+            triples = _checkpoint(triples, 1, _candidates_path('prob'), test_users, done)
+            triples = _checkpoint(triples, 2, _candidates_path('filled'), test_users, done)
+
+        out = open(results, 'a' if done else 'w')
+        try:
+            filled = ((user, suggestions) for user, prob, suggestions in triples)
+            for user, blended in blend.blend_candidates(filled, 10):
+                out.write("{0}:{1}\n".format(user, ",".join(map(str, blended))))
+                out.flush()
+        finally:
+            out.close()
+
+    if checkpoints:
+        util.write_manifest(_candidates_path('prob'), _sources('prob'))
+        util.write_manifest(_candidates_path('filled'), _sources('filled'))
+
+    metrics.count('stream_users', len(todo))
+
+def _finished_users(path):
+    """
+    Returns the users with a complete line in a results file,
+    cutting off a last line left unfinished by an interrupted run.
+    """
+    if not os.path.exists(path):
+        return set()
+
+    f = open(path, 'r+b')
+    try:
+        text = f.read()
+        complete = text.rfind('\n') + 1
+        if complete < len(text):
+            logger.info("Dropping an unfinished line from {0}".format(path))
+            f.truncate(complete)
+    finally:
+        f.close()
+
+    return set(int(line.split(':')[0]) for line in text[:complete].splitlines())
+
+def _checkpoint(triples, field, path, test_users, done):
+    """
+    Passes triples through, writing the candidates at the given
+    position of each to a candidate file. A resumed run keeps
+    the lists of the users already done.
+    """
+    resuming = done and os.path.exists(path)
+
+    if config.CANDIDATE_FORMAT == 'binary':
+        if not (resuming and candfile.is_binary(path)):
+            candfile.create(path, test_users, 20)
+        writer = candfile.Reader(path, writable=True)
+        put = writer.put
+    else:
+        kept = {}
+        if resuming:
+            kept = dict(item for item in util.iter_candidates(path) if item[0] in done)
+        util.write_candidates(kept, path, 20)
+        writer = open(path, 'a')
+        put = lambda user, suggestions: writer.write(
+            "{0}:{1}\n".format(user, ",".join(map(str, suggestions[:20]))))
+
+    try:
+        for triple in triples:
+            put(triple[0], triple[field])
+            yield triple
+    finally:
+        writer.close()
+
+def refresh(analysis=None, watch_lines=(), repo_ids=(), user_ids=()):
+    """
+    Applies new 'user:repo' watch lines to the model, then
+    recomputes the stored candidates of the test users affected
+    by them or by the given changed repos and users, and blends
+    the results again.
+    """
+    for path in (_candidates_path('prob'), _candidates_path('filled')):
+        if not os.path.exists(path):
+            raise IOError("{0} does not exist, run the candidates and fill stages first".format(path))
+
+    repo_ids = set(repo_ids)
+    user_ids = set(user_ids)
+    if watch_lines:
+        with metrics.timed('update_model'):
+            repo_ids.update(tokyo.update_conditional_probabilities(watch_lines))
+        user_ids.update(int(line.split(':')[0]) for line in watch_lines)
+
+    if config.MODEL_FORMAT == 'csr' and not csr.database_exists():
+        convert_model()
+
+    analysis = analysis or analyzers.Analysis()
+    with metrics.timed('refresh'):
+        analysis.refresh_candidates(_candidates_path('prob'), _candidates_path('filled'),
+                                    repo_ids, user_ids, 20)
+    util.write_manifest(_candidates_path('prob'), _sources('prob'))
+    util.write_manifest(_candidates_path('filled'), _sources('filled'))
 
-analysis = analyzers.Analysis()
+    blend_results(analysis)
 
-base_probabilistic_candidates = 'results-prob-20.txt'
-filled_candidates = 'results-filled-20.txt'
+_commands = {
+    'build-model': build_model,
+    'candidates': probabilistic,
+    'fill': fill,
+    'blend': blend_results,
+    'all': run_all,
+    'stream': stream,
+    'refresh': refresh,
+    }
 
-candidates = None
+def _ids(option, opt, value, parser):
+    setattr(parser.values, option.dest, [int(id) for id in value.split(',') if id])
 
-if not tokyo.database_exists():
-    tokyo.compute_conditional_probabilities()
+def main():
+    parser = optparse.OptionParser(
+        usage="%prog [options] [{0}]".format("|".join(sorted(_commands))),
+        description="Runs one stage of the pipeline, or all of them by default.")
+    parser.add_option('-w', '--watches', metavar='FILE',
+                      help="refresh: file of new 'user:repo' watch lines to apply")
+    parser.add_option('-r', '--repos', type='string', action='callback', callback=_ids, default=[],
+                      help="refresh: comma separated ids of other changed repos")
+    parser.add_option('-u', '--users', type='string', action='callback', callback=_ids, default=[],
+                      help="refresh: comma separated ids of other changed users")
+    parser.add_option('-c', '--checkpoints', action='store_true', default=None,
+                      help="stream: also write the 20 candidate files")
+    parser.add_option('--restart', action='store_true', default=False,
+                      help="stream: start over instead of skipping users already in results.txt")
+    options, args = parser.parse_args()
 
-if not os.path.exists(base_probabilistic_candidates):
-    logger.debug("Could not find {0}, computing...".format(base_probabilistic_candidates))
-    candidates = analysis.get_probabilistic_candidates(20)
-    util.write_candidates(candidates, base_probabilistic_candidates, 20)
+    command = args[0] if args else 'all'
+    if len(args) > 1 or command not in _commands:
+        parser.error("Expected one of {0}".format(", ".join(sorted(_commands))))
 
-if not os.path.exists(filled_candidates):
-    candidates = util.read_candidates(base_probabilistic_candidates)
-    analysis.fill_candidates(candidates, 20)
-    util.write_candidates(candidates, filled_candidates, 20)
+    logging.basicConfig(level=getattr(logging, config.LOG_LEVEL),
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        filename=os.path.join(config.LOG_PATH, 'log.txt'),
+                        filemode='w')
 
-# At this point, run 'blend_unwatched_sources.rb > results-filled-20.txt'
+    if command == 'refresh':
+        watch_lines = []
+        if options.watches:
+            watch_lines = [line for line in open(options.watches) if line.strip()]
+        refresh(watch_lines=watch_lines, repo_ids=options.repos, user_ids=options.users)
+    elif command == 'stream':
+        stream(checkpoints=options.checkpoints, resume=not options.restart)
+    else:
+        _commands[command]()
 
+    metrics.report()
 
+if __name__ == '__main__':
+    main()
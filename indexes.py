@@ -0,0 +1,345 @@
+import array
+import bisect
+import collections
+import config
+import heapq
+import logging
+import os.path
+import re
+import users
+import util
+
+logger = logging.getLogger("ghc.indexes")
+
+class NameIndex:
+    """
+    Inverted index from the lowercase letter runs in repo names
+    to the repos whose names contain them. Posting lists hold
+    popularity ranks, so merging them yields repos from the most
+    to the least watched.
+    """
+    def __init__(self, repo_map, repo_freqs):
+        # Repo ids by descending popularity
+        self.ranked = _rank(repo_map, repo_freqs)
+
+        postings = collections.defaultdict(list)
+        for rank, repo_id in enumerate(self.ranked):
+            for word in set(re.findall('[a-z]+', repo_map[repo_id].name.lower())):
+                postings[word].append(rank)
+
+        self.words = sorted(postings)
+        self.postings = [array.array('i', postings[word]) for word in self.words]
+
+        # Every suffix of every word, sorted, so that the words
+        # containing a token are a prefix range of this list.
+        suffixes = sorted((word[start:], index)
+                          for index, word in enumerate(self.words)
+                          for start in xrange(len(word)))
+        self.suffixes = [suffix for suffix, index in suffixes]
+        self.suffix_words = array.array('i', [index for suffix, index in suffixes])
+
+        logger.debug("Indexed {0} repos under {1} words".format(len(self.ranked), len(self.words)))
+
+    def find(self, tokens):
+        """
+        Returns the ids of repos whose names contain any of
+        the tokens, case insensitively, most popular first.
+        Matches what re.search('|'.join(tokens), name, re.I)
+        matches for tokens made only of letters, including
+        matching every repo when there are no tokens.
+        """
+        tokens = set(token.lower() for token in tokens)
+        if not tokens:
+            return self.ranked.tolist()
+
+        words = set()
+        for token in tokens:
+            start = bisect.bisect_left(self.suffixes, token)
+            while start < len(self.suffixes) and self.suffixes[start].startswith(token):
+                words.add(self.suffix_words[start])
+                start += 1
+
+        ranked = []
+        last = None
+        for rank in heapq.merge(*[self.postings[word] for word in words]):
+            if rank != last:
+                ranked.append(self.ranked[rank])
+                last = rank
+
+        return ranked
+
+class FamilyIndex:
+    """
+    Maps each forked or forking repo to its fork family, the
+    ancestors and descendants it is filled with, as ranks
+    sorted from the most to the least watched. Also holds the
+    global popularity ranking of every known repo.
+    """
+    def __init__(self, repo_map, repo_freqs):
+        # Watched repos missing from repos.txt are ranked too
+        self.ranked = _rank(set(repo_map) | set(repo_freqs), repo_freqs)
+        ranks = dict((repo_id, rank) for rank, repo_id in enumerate(self.ranked))
+
+        self.families = {}
+        lineage = repo_map.lineage
+        if lineage is not None:
+            for repo_id in repo_map:
+                relatives = lineage.ancestors(repo_id) + lineage.descendants(repo_id)
+                if relatives:
+                    self.families[repo_id] = array.array('i', sorted(ranks[r] for r in relatives))
+
+        logger.debug("Indexed the families of {0} repos".format(len(self.families)))
+
+    def family(self, repo_id):
+        """
+        Returns the ids of a repo's ancestors and descendants,
+        most popular first.
+        """
+        return [self.ranked[rank] for rank in self.families.get(repo_id, ())]
+
+    def find(self, repo_ids):
+        """
+        Returns the ids of the ancestors and descendants of
+        any of the given repos, most popular first, merged
+        from their presorted families.
+        """
+        families = [self.families[r] for r in repo_ids if r in self.families]
+
+        ranked = []
+        last = None
+        for rank in heapq.merge(*families):
+            if rank != last:
+                ranked.append(self.ranked[rank])
+                last = rank
+
+        return ranked
+
+class LanguageIndex:
+    """
+    Dense repo x language matrix of the line shares in lang.txt,
+    with each row scaled to unit length. Rows are in order of
+    popularity, so ties between equally similar repos go to the
+    more watched one. Needs NumPy.
+    """
+    def __init__(self, repo_map, repo_freqs):
+        numpy = _import_numpy()
+
+        ranked = [repo_id for repo_id in _rank(repo_map, repo_freqs)
+                  if repo_map[repo_id].languages]
+
+        columns = {}
+        for repo_id in ranked:
+            for lang, lines, share in repo_map[repo_id].languages:
+                columns.setdefault(lang, len(columns))
+
+        self.ids = numpy.array(ranked, dtype=numpy.int32)
+        self.rows = dict((repo_id, row) for row, repo_id in enumerate(ranked))
+        self.matrix = numpy.zeros((len(ranked), len(columns)), dtype=numpy.float32)
+        for row, repo_id in enumerate(ranked):
+            for lang, lines, share in repo_map[repo_id].languages:
+                self.matrix[row, columns[lang]] = share
+
+        norms = numpy.sqrt((self.matrix ** 2).sum(axis=1))
+        norms[norms == 0] = 1
+        self.matrix /= norms[:, numpy.newaxis]
+
+        logger.debug("Indexed {0} repos in {1} languages".format(len(ranked), len(columns)))
+
+    def nearest(self, watched_lists, counts, exclude):
+        """
+        For each list of watched repo ids, returns up to the
+        matching count of repo ids by descending cosine
+        similarity to the sum of their language rows. Watched
+        repos, repos in the matching exclude set and repos with
+        nothing in common are left out. Every profile of the
+        batch is scored in one matrix product.
+        """
+        numpy = _import_numpy()
+
+        profiles = numpy.zeros((len(watched_lists), self.matrix.shape[1]), dtype=numpy.float32)
+        for k, watched in enumerate(watched_lists):
+            rows = [self.rows[r] for r in watched if r in self.rows]
+            if rows:
+                profiles[k] = self.matrix[rows].sum(axis=0)
+
+        scores = numpy.dot(profiles, self.matrix.T)
+
+        nearest = []
+        for k, watched in enumerate(watched_lists):
+            # Enough of the best rows to survive the exclusions
+            take = min(counts[k] + len(watched) + len(exclude[k]), len(self.ids))
+            if take <= 0 or not profiles[k].any():
+                nearest.append([])
+                continue
+
+            row_scores = scores[k]
+            best = numpy.argpartition(-row_scores, take - 1)[:take]
+            best = best[numpy.lexsort((best, -row_scores[best]))]
+
+            found = []
+            for row in best:
+                if row_scores[row] <= 0 or len(found) == counts[k]:
+                    break
+                repo_id = int(self.ids[row])
+                if repo_id not in watched and repo_id not in exclude[k]:
+                    found.append(repo_id)
+            nearest.append(found)
+
+        return nearest
+
+class ReverseIndex:
+    """
+    Maps repo ids to the test users whose watches or stored
+    candidates reference them, so that a change to some repos
+    only touches the users who can see it.
+    """
+    def __init__(self, test_users, user_watches, candidates):
+        self.test_users = set(test_users)
+        self.users = collections.defaultdict(set)
+        # Name tokens of the users who read similarly named rows
+        self.tokens = {}
+
+        for user in self.test_users:
+            for repo_id in user_watches.get(user, ()):
+                self.users[repo_id].add(user)
+
+        for user, suggestions in candidates:
+            if user in self.test_users:
+                for repo_id in suggestions:
+                    self.users[repo_id].add(user)
+
+        logger.debug("Indexed the repos of {0} test users".format(len(self.test_users)))
+
+    def add(self, user, repo_ids):
+        """
+        Also maps the given repos, such as other model rows the
+        user's candidates were computed from, to a test user.
+        """
+        for repo_id in repo_ids:
+            self.users[repo_id].add(user)
+
+    def add_tokens(self, user, tokens):
+        """
+        Also maps to a test user every repo whose name contains
+        one of the tokens, as NameIndex.find matches them. No
+        tokens match every repo.
+        """
+        self.tokens[user] = set(token.lower() for token in tokens)
+
+    def affected(self, repo_ids, user_ids=(), names=None):
+        """
+        Returns the test users referencing any of the repos,
+        plus those of the given users who are test users. names
+        maps repo ids to names for matching the added tokens.
+        """
+        affected = self.test_users.intersection(user_ids)
+        for repo_id in repo_ids:
+            affected.update(self.users.get(repo_id, ()))
+
+        for repo_id, name in (names or {}).iteritems():
+            name = name.lower()
+            for user, tokens in self.tokens.iteritems():
+                if user not in affected and (not tokens or any(token in name for token in tokens)):
+                    affected.add(user)
+
+        return affected
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("The language index requires numpy")
+    return numpy
+
+def _rank(repo_ids, repo_freqs):
+    """
+    Returns the repo ids by descending frequency, ties going
+    to the lower id, as an array.
+    """
+    def popularity(repo_id):
+        freq = repo_freqs[repo_id][0] if repo_id in repo_freqs else 0
+        return -freq, repo_id
+
+    return array.array('i', sorted(repo_ids, key=popularity))
+
+def _sources():
+    # Names and forks come from repos.txt, popularity from
+    # the watches in data.txt
+    return [os.path.join(config.SRC_DATA_PATH, 'repos.txt'),
+            os.path.join(config.SRC_DATA_PATH, 'data.txt')]
+
+_name_index = None
+_family_index = None
+_language_index = None
+
+def get_name_index(load):
+    """
+    Returns the NameIndex, loading it from or storing it to
+    the calculated data directory. load is only called, for
+    the (repo_map, repo_freqs) to build it from, when the
+    stored index is missing or stale.
+    """
+    path = os.path.join(config.CALC_DATA_PATH, 'name_index.pickle')
+    sources = _sources()
+    global _name_index
+    name_index = _name_index or util.load_cache(path, sources)
+    if name_index:
+        _name_index = name_index
+        return name_index
+
+    logger.debug("Building name index")
+
+    name_index = NameIndex(*load())
+
+    util.store_cache(name_index, path, sources, debug=False)
+    _name_index = name_index
+
+    return name_index
+
+def get_family_index(load):
+    """
+    Returns the FamilyIndex, loading it from or storing it to
+    the calculated data directory. load is only called, for
+    the (repo_map, repo_freqs) to build it from, when the
+    stored index is missing or stale.
+    """
+    path = os.path.join(config.CALC_DATA_PATH, 'family_index.pickle')
+    sources = _sources()
+    global _family_index
+    family_index = _family_index or util.load_cache(path, sources)
+    if family_index:
+        _family_index = family_index
+        return family_index
+
+    logger.debug("Building family index")
+
+    family_index = FamilyIndex(*load())
+
+    util.store_cache(family_index, path, sources, debug=False)
+    _family_index = family_index
+
+    return family_index
+
+def get_language_index(load):
+    """
+    Returns the LanguageIndex, loading it from or storing it to
+    the calculated data directory. load is only called, for
+    the (repo_map, repo_freqs) to build it from, when the
+    stored index is missing or stale.
+    """
+    path = os.path.join(config.CALC_DATA_PATH, 'language_index.pickle')
+    sources = [os.path.join(config.SRC_DATA_PATH, 'lang.txt')] + _sources()
+    global _language_index
+    language_index = _language_index or util.load_cache(path, sources)
+    if language_index:
+        _language_index = language_index
+        return language_index
+
+    logger.debug("Building language index")
+
+    language_index = LanguageIndex(*load())
+
+    util.store_cache(language_index, path, sources, debug=False)
+    _language_index = language_index
+
+    return language_index
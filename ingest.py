@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Bulk readers for the raw contest files.
+
+Each file is read into memory in one go and split as a whole
+buffer rather than parsed line by line with regexes and
+strptime. Creation dates repeat a lot, so each distinct date
+string is parsed once. NumPy, when it is installed, parses and
+groups the watches in bulk. users and repos build their structures
+from what these functions return.
+
+Run as a script to time a cold start of every reader.
+"""
+
+from __future__ import division
+from datetime import datetime
+import array
+import collections
+import config
+import itertools
+import logging
+import metrics
+import optparse
+import os.path
+
+logger = logging.getLogger("ghc.ingest")
+
+def data_path():
+    return os.path.join(config.SRC_DATA_PATH, 'data.txt')
+
+def repos_path():
+    return os.path.join(config.SRC_DATA_PATH, 'repos.txt')
+
+def lang_path():
+    return os.path.join(config.SRC_DATA_PATH, 'lang.txt')
+
+def test_path():
+    return os.path.join(config.SRC_DATA_PATH, 'test.txt')
+
+def read_watches(path=None):
+    """
+    Reads the 'user:repo' lines of data.txt into two parallel
+    int arrays of user ids and repo ids, in file order. With
+    NumPy the whole buffer is parsed in one call.
+    """
+    buf = _read(path or data_path()).replace(':', ' ')
+
+    numpy = _numpy()
+    if numpy is not None:
+        fields = numpy.fromstring(buf, dtype=numpy.int32, sep=' ')
+        # fromstring stops quietly at the first malformed field
+        if len(fields) == 2 * _count_lines(buf):
+            return (array.array('i', fields[0::2].tostring()),
+                    array.array('i', fields[1::2].tostring()))
+
+    fields = buf.split()
+    users = array.array('i', map(int, fields[0::2]))
+    repos = array.array('i', map(int, fields[1::2]))
+    return users, repos
+
+def iter_watches(path=None, chunk_bytes=1 << 20, offset=0):
+    """
+    Streams the watches of data.txt as pairs of user id and repo
+    id arrays, like read_watches returns, for about chunk_bytes
+    of lines at a time, so the whole file is never in memory.
+    Starts reading at the byte offset, which must be at the
+    start of a line or at its newline.
+    """
+    f = open(path or data_path(), 'rb')
+    try:
+        f.seek(offset)
+        while True:
+            lines = f.readlines(chunk_bytes)
+            if not lines:
+                break
+            fields = ''.join(lines).replace(':', ' ').split()
+            yield array.array('i', map(int, fields[0::2])), array.array('i', map(int, fields[1::2]))
+    finally:
+        f.close()
+
+def group_watches(users, repos):
+    """
+    Returns a dict of user id keys mapped to the set of repo
+    ids they watch, from the arrays of read_watches. With NumPy
+    the watches are sorted by user and each user's set is built
+    from one slice.
+    """
+    user_watches = collections.defaultdict(set)
+
+    numpy = _numpy()
+    if numpy is None or not users:
+        for user, repo in itertools.izip(users, repos):
+            user_watches[user].add(repo)
+        return user_watches
+
+    users = numpy.frombuffer(users, dtype=numpy.int32)
+    repos = numpy.frombuffer(repos, dtype=numpy.int32)
+    order = numpy.argsort(users, kind='mergesort')
+    users = users[order]
+    repos = repos[order].tolist()
+    starts = numpy.flatnonzero(numpy.diff(users)) + 1
+
+    bounds = [0] + starts.tolist() + [len(repos)]
+    for k, user in enumerate(users[bounds[:-1]].tolist()):
+        user_watches[user] = set(repos[bounds[k]:bounds[k + 1]])
+    return user_watches
+
+def read_repos(path=None):
+    """
+    Reads repos.txt into a list of (id, user, name, created
+    date ordinal, fork) tuples sorted by id. fork is None for
+    repos that are not forks. Owner strings are shared between
+    the repos of each owner.
+    """
+    owners = {}
+    rows = []
+    for line in _read(path or repos_path()).splitlines():
+        if not line:
+            continue
+        fields = line.split(',')
+        id, meta = fields[0].split(':', 1)
+        user, name = meta.split('/', 1)
+        fork = int(fields[2]) if len(fields) == 3 else None
+        rows.append((int(id), owners.setdefault(user, user), name,
+                     _date_ordinal(fields[1]), fork))
+
+    rows.sort()
+    return rows
+
+def read_languages(path=None):
+    """
+    Reads lang.txt into a dict of repo id keys mapped to lists
+    of (language, raw lines, share of the repo's lines) tuples.
+    Repos without any lines are left out.
+    """
+    languages = {}
+    for line in _read(path or lang_path()).splitlines():
+        if not line:
+            continue
+        repo_id, langs = line.split(':', 1)
+        pairs = [pair.split(';') for pair in langs.split(',')]
+        counts = [int(lines) for lang, lines in pairs]
+
+        total_lines = sum(counts)
+        if total_lines == 0:
+            continue
+
+        languages.setdefault(int(repo_id), []).extend(
+            (lang, lines, lines / total_lines) for (lang, text), lines in zip(pairs, counts))
+
+    return languages
+
+def _count_lines(buf):
+    return buf.count('\n') + (1 if buf and not buf.endswith('\n') else 0)
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+def _read(path):
+    f = open(path, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+# Date string -> ordinal, repos.txt only has a few thousand dates
+_dates = {}
+
+def _date_ordinal(text):
+    ordinal = _dates.get(text)
+    if ordinal is None:
+        ordinal = _dates[text] = datetime.strptime(text, '%Y-%m-%d').date().toordinal()
+    return ordinal
+
+def timing_report():
+    """
+    Times a cold read of each raw file, logs the time, size and
+    throughput of each, and returns them as a list of dicts.
+    """
+    readers = [('data.txt', data_path(), read_watches),
+               ('repos.txt', repos_path(), read_repos),
+               ('lang.txt', lang_path(), read_languages)]
+
+    report = []
+    for name, path, reader in readers:
+        _dates.clear()
+        with metrics.timed('ingest ' + name) as timer:
+            result = reader(path)
+        records = len(result[0]) if isinstance(result, tuple) else len(result)
+        megabytes = os.path.getsize(path) / (1024 * 1024)
+        report.append({'file': name, 'records': records, 'megabytes': megabytes,
+                       'seconds': timer.seconds})
+        logger.info("{0}: {1} records, {2:.1f} MB in {3:.2f}s ({4:.1f} MB/s)".format(
+                name, records, megabytes, timer.seconds,
+                megabytes / timer.seconds if timer.seconds else 0))
+
+    logger.info("Cold start ingest: {0:.2f}s".format(sum(r['seconds'] for r in report)))
+    return report
+
+def main():
+    parser = optparse.OptionParser(usage="%prog",
+                                   description="Times a cold read of the raw data files.")
+    parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    timing_report()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Run metrics: stage timers, event counters and memory high-water
+marks, reported as one summary at the end of a run.
+
+Counters are plain dict increments so they can be left on in the
+hot paths. Worker processes collect their own counters, which
+are merged back into the parent with merge().
+"""
+
+from __future__ import division
+import logging
+import resource
+import time
+
+logger = logging.getLogger("ghc.metrics")
+
+# (stage name, seconds, peak memory in KB) in the order stages finished
+_stages = []
+_counters = {}
+
+def count(name, amount=1):
+    """
+    Adds amount to the named counter.
+    """
+    _counters[name] = _counters.get(name, 0) + amount
+
+def counters():
+    return dict(_counters)
+
+def merge(other):
+    """
+    Adds the counters collected elsewhere, such as in a
+    worker process, to this process's counters.
+    """
+    for name, amount in other.iteritems():
+        count(name, amount)
+
+def reset():
+    del _stages[:]
+    _counters.clear()
+
+def peak_memory():
+    """
+    The resident memory high-water mark of this process, in KB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class timed:
+    """
+    Context manager that times a stage of the run and records
+    the memory high-water mark at its end, and how much the
+    stage raised it.
+
+        with metrics.timed('fill'):
+            ...
+    """
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        logger.info("Starting {0}".format(self.stage))
+        self.start = time.time()
+        self.start_memory = peak_memory()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.seconds = time.time() - self.start
+        # How far this stage raised the high-water mark; a stage
+        # that stays under an earlier peak shows 0
+        self.memory_growth_kb = peak_memory() - self.start_memory
+        _stages.append((self.stage, self.seconds, peak_memory()))
+
+def report():
+    """
+    Logs the summary of the run and returns it as a dict.
+    """
+    summary = {
+        'stages': [{'name': name, 'seconds': seconds, 'peak_memory_kb': memory}
+                   for name, seconds, memory in _stages],
+        'counters': counters(),
+        'peak_memory_kb': peak_memory(),
+        }
+
+    logger.info("Run summary")
+    for name, seconds, memory in _stages:
+        logger.info("  {0:<24} {1:>10.2f}s {2:>12} KB peak".format(name, seconds, memory))
+    for name in sorted(_counters):
+        logger.info("  {0:<24} {1:>12}".format(name, _counters[name]))
+    logger.info("  {0:<24} {1:>12} KB".format('peak memory', summary['peak_memory_kb']))
+
+    return summary
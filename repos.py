@@ -1,29 +1,83 @@
 from __future__ import division
-from datetime import datetime
+from datetime import date
+import array
+import collections
 import config
+import ingest
+import itertools
 import logging
+import marshal
+import multiprocessing
 import os
 import pickle
-import re
+import Queue
+import resource
 import simplejson as json
+import time
+import util
 
 logger = logging.getLogger("ghc.repos")
 
-class Repo:
-    def __init__(self, id, user, name, date, fork=None):
-        self.id = int(id)
-        self.user = user
-        self.name = name
-        self.created = datetime.strptime(date, '%Y-%m-%d').date()
-        self.fork = int(fork) if fork != None else None
-        # References to Repo objects that this is a direct
-        # or indirect fork of.
-        self.ancestors = []
-        # References to Repo objects that directly or indirectly
-        # fork this project
-        self.descendants = []
-        # An array of tuples that contains (language, raw lines, %lines)
-        self.languages =[]
+class Repo(object):
+    """
+    A lightweight view of one row of a RepoStore. Exposes the
+    same attributes the Repo objects used to carry.
+    """
+    __slots__ = ('store', 'row')
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    @property
+    def id(self):
+        return self.store.ids[self.row]
+
+    @property
+    def user(self):
+        return self.store.owners[self.row]
+
+    @property
+    def name(self):
+        return self.store.names[self.row]
+
+    @property
+    def created(self):
+        return date.fromordinal(self.store.created[self.row])
+
+    @property
+    def fork(self):
+        fork = self.store.forks[self.row]
+        return fork if fork != -1 else None
+
+    @property
+    def languages(self):
+        """
+        A list of tuples that contains (language, raw lines, %lines)
+        """
+        return self.store.languages(self.row)
+
+    @property
+    def ancestors(self):
+        """
+        References to Repo objects that this is a direct
+        or indirect fork of, nearest first.
+        """
+        lineage = self.store.lineage
+        if lineage is None:
+            return []
+        return [self.store[r] for r in lineage.ancestors(self.id)]
+
+    @property
+    def descendants(self):
+        """
+        References to Repo objects that directly or indirectly
+        fork this project
+        """
+        lineage = self.store.lineage
+        if lineage is None:
+            return []
+        return [self.store[r] for r in lineage.descendants(self.id)]
 
     def __eq__(self, other):
         return self.id == other.id
@@ -60,10 +114,184 @@ class Repo:
                 'languages' : self.languages
                 }, sort_keys=True, indent=2)
 
+class RepoStore(object):
+    """
+    Struct of arrays holding every repo, one row per repo in
+    ascending id order. Behaves like the dict of repo id -> Repo
+    it replaces, handing out Repo views on access.
+    """
+    def __init__(self):
+        self.ids = array.array('i')
+        self.owners = []
+        self.names = []
+        # Creation dates as proleptic Gregorian ordinals
+        self.created = array.array('i')
+        # Id of the forked repo, or -1
+        self.forks = array.array('i')
+        # Languages of row r are entries lang_offsets[r] up to
+        # lang_offsets[r + 1] of the lang_* arrays.
+        self.lang_names = []
+        self.lang_offsets = array.array('i', [0])
+        self.lang_ids = array.array('i')
+        self.lang_lines = array.array('i')
+        self.lang_shares = array.array('d')
+        self.lineage = None
+        # Repo id -> row, -1 where there is no repo
+        self._rows = array.array('i')
+
+    def append(self, id, user, name, created, fork):
+        """
+        Adds a repo. Rows must be appended in ascending id order.
+        """
+        if self.ids and id <= self.ids[-1]:
+            raise ValueError("Repo {0} is out of order".format(id))
+
+        row = len(self.ids)
+        self.ids.append(id)
+        self.owners.append(user)
+        self.names.append(name)
+        self.created.append(created)
+        self.forks.append(fork if fork is not None else -1)
+        self.lang_offsets.append(self.lang_offsets[-1])
+
+        if id >= len(self._rows):
+            self._rows.extend([-1] * (id + 1 - len(self._rows)))
+        self._rows[id] = row
+
+    def set_languages(self, languages):
+        """
+        Given a map of repo id -> list of (language, raw lines, %lines)
+        tuples, replaces the language columns.
+        """
+        lang_index = {}
+        self.lang_names = []
+        self.lang_offsets = array.array('i', [0])
+        self.lang_ids = array.array('i')
+        self.lang_lines = array.array('i')
+        self.lang_shares = array.array('d')
+
+        for repo_id in self.ids:
+            for lang, lines, share in languages.get(repo_id, ()):
+                if lang not in lang_index:
+                    lang_index[lang] = len(self.lang_names)
+                    self.lang_names.append(lang)
+                self.lang_ids.append(lang_index[lang])
+                self.lang_lines.append(lines)
+                self.lang_shares.append(share)
+            self.lang_offsets.append(len(self.lang_ids))
+
+    def languages(self, row):
+        start, end = self.lang_offsets[row], self.lang_offsets[row + 1]
+        return [(self.lang_names[self.lang_ids[k]], self.lang_lines[k], self.lang_shares[k])
+                for k in xrange(start, end)]
+
+    def row(self, repo_id):
+        if 0 <= repo_id < len(self._rows):
+            row = self._rows[repo_id]
+            if row != -1:
+                return row
+        raise KeyError(repo_id)
+
+    def __getitem__(self, repo_id):
+        return Repo(self, self.row(repo_id))
+
+    def __contains__(self, repo_id):
+        return 0 <= repo_id < len(self._rows) and self._rows[repo_id] != -1
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def keys(self):
+        return self.ids.tolist()
+
+    def itervalues(self):
+        for row in xrange(len(self.ids)):
+            yield Repo(self, row)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for row in xrange(len(self.ids)):
+            yield self.ids[row], Repo(self, row)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def save(self, path):
+        """
+        Writes the columns with marshal, which loads them
+        back far faster than unpickling an object graph.
+        """
+        lineage = self.lineage
+        columns = (_store_version,
+                   self.ids.tostring(), self.owners, self.names,
+                   self.created.tostring(), self.forks.tostring(),
+                   self.lang_names, self.lang_offsets.tostring(), self.lang_ids.tostring(),
+                   self.lang_lines.tostring(), self.lang_shares.tostring(),
+                   lineage.order.tostring() if lineage else None,
+                   lineage.end.tostring() if lineage else None,
+                   lineage.parent.tostring() if lineage else None,
+                   lineage.cycles if lineage else None)
+
+        out = open(path, 'wb')
+        try:
+            marshal.dump(columns, out)
+        finally:
+            out.close()
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a store written by save. Returns None if it
+        was written by an incompatible version.
+        """
+        in_ = open(path, 'rb')
+        try:
+            columns = marshal.load(in_)
+        finally:
+            in_.close()
+
+        if columns[0] != _store_version:
+            return None
+
+        (version, ids, owners, names, created, forks,
+         lang_names, lang_offsets, lang_ids, lang_lines, lang_shares,
+         order, end, parent, cycles) = columns
+
+        store = cls()
+        store.ids.fromstring(ids)
+        store.owners = owners
+        store.names = names
+        store.created.fromstring(created)
+        store.forks.fromstring(forks)
+        store.lang_names = lang_names
+        store.lang_offsets = array.array('i')
+        store.lang_offsets.fromstring(lang_offsets)
+        store.lang_ids.fromstring(lang_ids)
+        store.lang_lines.fromstring(lang_lines)
+        store.lang_shares.fromstring(lang_shares)
+
+        if len(store.ids):
+            store._rows = array.array('i', [-1]) * (store.ids[-1] + 1)
+            for row, repo_id in enumerate(store.ids):
+                store._rows[repo_id] = row
+
+        if order is not None:
+            store.lineage = Lineage.from_arrays(store, order, end, parent, cycles)
+
+        return store
+
+# Bump whenever the layout written by RepoStore.save changes
+_store_version = 1
+
 def get_repos():
     """
-    Pull the data out of repos.txt into Repo objects.
-    Hashes them by repo id
+    Pull the data out of repos.txt into a RepoStore,
+    which maps repo ids to Repo views.
     """
     repos = _load_repos()
 
@@ -72,157 +300,300 @@ def get_repos():
     
     logger.debug("Building repos")
 
-    repos = {}
-
-    for line in open(os.path.join(config.SRC_DATA_PATH, 'repos.txt')):
-        repo = _read_repo(line)
-        repos[repo.id] = repo
+    repos = RepoStore()
+    for id, user, name, created, fork in ingest.read_repos(os.path.join(config.SRC_DATA_PATH, 'repos.txt')):
+        repos.append(id, user, name, created, fork)
     _set_lineage(repos)
     _set_languages(repos)
 
-    _store_repos(repos, debug=True)
+    _store_repos(repos)
     
     return repos
         
-def _get_ancestry_cmp(repo_map):
-    """
-    Sort by created at. Time resolution is
-    not in milliseconds and there are frequent
-    ties. Use repo id as a tiebreaker.
-
-    This method must ensure that ancestors
-    show up before their dependents. There are
-    cases where this is tricky, such as a repo
-    forked from another repo that was itself
-    forked, and all this happened on the same
-    day. In that case, use the parent repos
-    as the parameters and recurse until a
-    definitive tie-breaking condition is found.
-    """
-    def repo_sort(x,y):
-        ret = cmp(x.created, y.created)
-        if ret != 0: return ret
-        if not x.is_forked() and y.is_forked(): return -1
-        if x.is_forked() and not y.is_forked(): return 1
-        if x.is_forked() and y.is_forked(): return repo_sort(repo_map[x.fork], repo_map[y.fork])
-        return cmp(x.id, y.id)
-
-    return repo_sort
-
-def _read_repo(line):
+class Lineage(object):
     """
-    Given a line in repos.txt, create a basic Repo object.
+    Ancestry of every repo in the fork forest, built by a single
+    depth first traversal from the root repos using only the fork
+    field. Repos are numbered in preorder, which makes the
+    descendants of a repo the contiguous range that follows it
+    (an Euler tour interval). Ancestors are the chain of fork
+    parents. Everything is stored in flat arrays indexed by
+    preorder position.
     """
-    tmp = line.rstrip().split(',')
-    id, meta = tmp[0].split(':')
-    user, name = meta.split('/')
-    fork = tmp[2] if len(tmp) == 3 else None
-    return Repo(id, user, name, tmp[1], fork)
+    def __init__(self, repos):
+        self.repos = repos
+
+        children = collections.defaultdict(list)
+        roots = []
+        for repo_id in sorted(repos):
+            fork = repos[repo_id].fork
+            if fork is None or fork not in repos:
+                roots.append(repo_id)
+            else:
+                children[fork].append(repo_id)
+
+        # Repo id at each preorder position
+        self.order = array.array('i')
+        # Position one past the last descendant of each position
+        self.end = array.array('i')
+        # Position of the parent of each position, or -1
+        self.parent = array.array('i')
+        # Repo id -> preorder position
+        self.position = {}
+
+        for root in roots:
+            self._traverse(root, children)
+
+        # Repos whose fork chain loops back on itself are never
+        # reached from a root. Cut each such cycle at the first
+        # repo on it and traverse from there.
+        self.cycles = []
+        for repo_id in sorted(repos):
+            if repo_id in self.position:
+                continue
+
+            seen = set()
+            while repo_id not in seen:
+                seen.add(repo_id)
+                repo_id = repos[repo_id].fork
+
+            logger.warning("Repo {0} is part of a fork cycle".format(repo_id))
+            self.cycles.append(repo_id)
+            self._traverse(repo_id, children)
+
+    def _traverse(self, root, children):
+        order, end, parent, position = self.order, self.end, self.parent, self.position
+
+        stack = [(root, -1)]
+        while stack:
+            repo_id, parent_position = stack.pop()
+            if repo_id is None:
+                # Every descendant of this position has been numbered
+                end[parent_position] = len(order)
+                continue
+            if repo_id in position:
+                continue
+
+            position[repo_id] = len(order)
+            order.append(repo_id)
+            end.append(0)
+            parent.append(parent_position)
+
+            stack.append((None, position[repo_id]))
+            for child in reversed(children.get(repo_id, ())):
+                stack.append((child, position[repo_id]))
+
+    @classmethod
+    def from_arrays(cls, repos, order, end, parent, cycles):
+        """
+        Rebuilds a Lineage from the arrays saved by a RepoStore.
+        """
+        lineage = cls.__new__(cls)
+        lineage.repos = repos
+        lineage.order = array.array('i')
+        lineage.order.fromstring(order)
+        lineage.end = array.array('i')
+        lineage.end.fromstring(end)
+        lineage.parent = array.array('i')
+        lineage.parent.fromstring(parent)
+        lineage.position = dict(itertools.izip(lineage.order, itertools.count()))
+        lineage.cycles = cycles
+        return lineage
+
+    def ancestors(self, repo_id):
+        """
+        Ids of the repos this repo is a direct or
+        indirect fork of, nearest first.
+        """
+        ids = []
+        p = self.parent[self.position[repo_id]]
+        while p != -1:
+            ids.append(self.order[p])
+            p = self.parent[p]
+        return ids
+
+    def descendants(self, repo_id):
+        """
+        Ids of the repos that directly or indirectly
+        fork this repo, in preorder.
+        """
+        p = self.position[repo_id]
+        return self.order[p + 1:self.end[p]].tolist()
+
+    def date_anomalies(self):
+        """
+        Returns (repo, parent) pairs where a fork claims to have
+        been created before the repo it was forked from.
+        """
+        anomalies = []
+        for p, repo_id in enumerate(self.order):
+            if self.parent[p] == -1:
+                continue
+            repo, parent = self.repos[repo_id], self.repos[self.order[self.parent[p]]]
+            if repo.created < parent.created:
+                anomalies.append((repo, parent))
+        return anomalies
 
 def _set_lineage(repos):
     """
     Build the lineage data between repos
-    """
-
-    # The timestamps do not have a high enough resolution
-    # for true sorting. This sorting algorithm will put
-    # the repos in order by date, with the guarantee
-    # that a given repo always comes after the repo
-    # it was forked from.
-    #
-    # Note that the data from github contained a few
-    # anomalies where the forked repo had a timestamp
-    # that was later than it's child. The assert
-    # statement later in this method catches these
-    # cases. They were fixed by hand.
-    sorted_repos = sorted(repos.values(), cmp=_get_ancestry_cmp(repos))
-    
-    for repo in sorted_repos:
-        if repo.is_forked():
-
-            forked = repos[repo.fork]
-
-            repo.ancestors.append(forked)
-
-            forked.descendants.append(repo)
-
-            # Use a local function to recurse through each
-            # ancestor
-            def update_ancestry_chain(r, f):
-                assert len(f.ancestors) > 0, "Forked project {0} from {1} has no ancestors".format(f, r)
-                # Add the current project as a descendant of it's ancestors
-                # Add each project as an ancestor of the current project
-                for ancestor in f.ancestors:
-                    if not ancestor in r.ancestors: 
-                        r.ancestors.append(ancestor) 
 
-                    if not r in ancestor.descendants: 
-                        ancestor.descendants.append(r)
+    This runs in time linear in the number of repos and does not
+    depend on the created dates. Forks dated before the repo they
+    were forked from are logged rather than needing a hand fix.
+    """
+    lineage = Lineage(repos)
+    repos.lineage = lineage
 
-                    # Recurse
-                    if ancestor.is_forked(): 
-                        update_ancestry_chain(r, ancestor)
+    anomalies = lineage.date_anomalies()
+    for repo, parent in anomalies:
+        logger.warning("Fork {0} was created before its parent {1}".format(repo, parent))
+    logger.debug("Found {0} fork date anomalies".format(len(anomalies)))
 
-            if forked.is_forked(): 
-                update_ancestry_chain(repo, forked)
+    return lineage
 
 def _set_languages(repos):
     """
-    Given a map of repo.id -> repo, add the language data in
+    Given a RepoStore, add the language data in
     the lang.txt file.
     """
-    for line in open(os.path.join(config.SRC_DATA_PATH, 'lang.txt')):
-        repo_id,languages = line.split(':')
-        total_lines = sum([int(count) for count in re.findall(r';(\d+),?', languages)])
-
-        if total_lines == 0: continue
+    languages = ingest.read_languages(os.path.join(config.SRC_DATA_PATH, 'lang.txt'))
 
-        if int(repo_id) not in repos:
+    for repo_id in languages.keys():
+        if repo_id not in repos:
             logger.debug("Could not find repo {0} while setting lang".format(repo_id))
-            continue
-
-        repo = repos[int(repo_id)]
-
-        for pair in languages.split(','):
-            lang,lines = pair.split(';')
-            repo.languages.append((lang, int(lines), int(lines)/total_lines))
+            del languages[repo_id]
 
+    repos.set_languages(languages)
 
+def _sources():
+    return [os.path.join(config.SRC_DATA_PATH, 'repos.txt'),
+            os.path.join(config.SRC_DATA_PATH, 'lang.txt')]
 
-def _store_repos(repo_map, debug=False, overwrite=False):
+def _store_repos(repos, debug=None):
     """
-    Stores the repos hash to a pickled file.
-    If debug is true, als generates a readable
-    JSON text file.
+    Saves the RepoStore to repos.store and records the
+    source files it was built from. If debug (default
+    config.DEBUG_DUMPS) is true, also generates a
+    readable JSON text file.
     """
-    path = os.path.join(config.CALC_DATA_PATH, 'repos.pickle')
+    path = os.path.join(config.CALC_DATA_PATH, 'repos.store')
 
-    if os.path.exists(path) and not overwrite:
-        return
+    if debug is None:
+        debug = config.DEBUG_DUMPS
     
-    logger.debug("Dumping pickle file {0}".format(path))
+    logger.debug("Saving repo store {0}".format(path))
 
-    pickle.dump(repo_map, open(path, "w"))
+    repos.save(path)
+    util.write_manifest(path, _sources())
 
-    logger.debug("Dumped pickle file {0}".format(path))
+    logger.debug("Saved repo store {0}".format(path))
 
     
     if debug:
         json_file = open(os.path.join(config.CALC_DATA_PATH, 'repos.json'), "w")
         logger.debug("Dumping json file {0}".format(json_file.name))
-        for repo in sorted(repo_map.values(), key=lambda x: x.id):
+        for repo in repos.itervalues():
             json_file.write("{0}\n".format(repo.to_json()))
         logger.debug("Dumped json file {0}".format(json_file.name))
         json_file.close()
 
 def _load_repos():
     """
-    Loads a dict of repos from a pickled file.
+    Loads the RepoStore from repos.store, unless the
+    source files changed since it was saved.
     """
-    path = os.path.join(config.CALC_DATA_PATH, 'repos.pickle')
-    if not os.path.exists(path):
+    path = os.path.join(config.CALC_DATA_PATH, 'repos.store')
+    if not util.is_fresh(path, _sources()):
         return None
 
-    logger.debug("Loading pickle file {0}".format(path))
+    logger.debug("Loading repo store {0}".format(path))
+
+    return RepoStore.load(path)
+
+def compare_with_pickle(pickle_path=None, store_path=None, timeout=600):
+    """
+    Loads repos.pickle, as written before the RepoStore, and
+    repos.store in separate processes. Logs and returns the
+    file size, load time and resident memory growth of each,
+    or the error that stopped a load.
+    """
+    pickle_path = pickle_path or os.path.join(config.CALC_DATA_PATH, 'repos.pickle')
+    store_path = store_path or os.path.join(config.CALC_DATA_PATH, 'repos.store')
+
+    report = {}
+    for label, path, load in (('pickle', pickle_path, _load_legacy_pickle),
+                              ('store', store_path, RepoStore.load)):
+        if not os.path.exists(path):
+            logger.info("Skipping {0}, {1} does not exist".format(label, path))
+            continue
+
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_measure_load, args=(load, path, results))
+        process.start()
+        outcome = _wait_for(process, results, timeout)
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+        if outcome[0] == 'error':
+            report[label] = {'bytes': os.path.getsize(path), 'error': outcome[1]}
+            logger.error("{0}: could not load {1}: {2}".format(label, path, outcome[1]))
+            continue
+
+        seconds, memory_kb = outcome
+        report[label] = {'bytes': os.path.getsize(path), 'seconds': seconds, 'memory_kb': memory_kb}
+        logger.info("{0}: {1} bytes, loaded in {2:.2f}s using {3} KB".format(
+                label, report[label]['bytes'], seconds, memory_kb))
+
+    return report
 
-    return pickle.load(open(path))
+def _wait_for(process, results, timeout):
+    """
+    Waits for the result of a measuring process, giving up
+    early if it exits without putting one on the queue.
+    """
+    start = time.time()
+    while True:
+        try:
+            return results.get(timeout=1)
+        except Queue.Empty:
+            if not process.is_alive():
+                process.join()
+                try:
+                    return results.get(timeout=1)
+                except Queue.Empty:
+                    return ('error', "exited with code {0}".format(process.exitcode))
+            if time.time() - start > timeout:
+                return ('error', "no result after {0}s".format(timeout))
+
+def _measure_load(load, path, results):
+    try:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        repos = load(path)
+        seconds = time.time() - start
+        results.put((seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before))
+    except Exception, e:
+        results.put(('error', repr(e)))
+
+class _LegacyRepo:
+    """
+    Stands in for the old Repo class, whose instances pickled
+    their attributes and cannot be restored into the slotted
+    Repo views.
+    """
+    pass
+
+class _LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if (module, name) == ('repos', 'Repo'):
+            return _LegacyRepo
+        return pickle.Unpickler.find_class(self, module, name)
+
+def _load_legacy_pickle(path):
+    f = open(path, 'rb')
+    try:
+        return _LegacyUnpickler(f).load()
+    finally:
+        f.close()
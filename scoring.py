@@ -0,0 +1,121 @@
+from __future__ import division
+import heapq
+import logging
+import math
+import metrics
+
+logger = logging.getLogger("ghc.scoring")
+
+# Weight of the log of the collocation count. Lets some
+# of the more popular repos bubble up over rare ones with
+# the same conditional probability.
+COFREQ_WEIGHT = .15
+
+_cofreq_factors = {}
+
+def weight(cofreq, prob):
+    """
+    The ranking weight of a related repo:
+    (1 + 0.15 * log(cofreq)) * prob
+    """
+    factor = _cofreq_factors.get(cofreq)
+    if factor is None:
+        factor = _cofreq_factors[cofreq] = 1 + COFREQ_WEIGHT * math.log(cofreq)
+    return factor * prob
+
+def select(related_repos, candidates, n):
+    """
+    Appends the best related repos to candidates until it holds n.
+
+    related_repos is a list of (watch, related_repo_id, cofreq, prob)
+    tuples as returned by Reader.get_related_repos. Each weight is
+    computed once and only the entries actually taken are popped off
+    a heap. Repos come out by descending weight, with ties going to
+    the later tuple, which is the order of popping from the end of a
+    stable ascending sort.
+    """
+    if len(candidates) >= n or not related_repos:
+        return
+
+    heap = [(-weight(cofreq, prob), -index, related)
+            for index, (watch, related, cofreq, prob) in enumerate(related_repos)]
+    heapq.heapify(heap)
+
+    debug = logger.isEnabledFor(logging.DEBUG)
+    chosen = set(candidates)
+    while len(candidates) < n and heap:
+        related = heapq.heappop(heap)[2]
+        if related not in chosen:
+            if debug:
+                logger.debug("Adding {0}".format(related))
+            candidates.append(related)
+            chosen.add(related)
+
+def cached_neighbors(cache, repo, read):
+    """
+    Returns the neighbors of a repo out of a reader's neighbor
+    cache, reading them with read(repo) on a miss.
+    """
+    neighbors = cache.get(repo)
+    if neighbors is None:
+        metrics.count('neighbor_cache_misses')
+        neighbors = read(repo)
+        cache.put(repo, neighbors)
+    else:
+        metrics.count('neighbor_cache_hits')
+    return neighbors
+
+def related_repos(db, user_watches):
+    """
+    Returns a list of (watch, related_repo_id, cofreq, prob)
+    tuples for the neighbors of each watched repo that are not
+    watched themselves, as the readers' get_related_repos do.
+    """
+    related_repos = list()
+    debug = logger.isEnabledFor(logging.DEBUG)
+
+    if debug:
+        logger.debug("Retrieving related repos for {0} watches".format(len(user_watches)))
+
+    for watch in user_watches:
+        neighbors = db.get_neighbors(watch)
+        metrics.count('pairs_scanned', len(neighbors))
+        for related, cofreq, cprob in neighbors:
+            # Don't add any repos already being watched
+            if related in user_watches:
+                continue
+            related_repos.append((watch, related, cofreq, cprob))
+
+    if debug:
+        logger.debug("Retrieved {0} related repos".format(len(related_repos)))
+    return related_repos
+
+def select_batch(db, user_watches, n, candidates=None):
+    """
+    Picks the top n related repos for a batch of users.
+
+    user_watches is a list of (user, watched_repos) pairs. Each
+    distinct watched repo is looked up once for the whole batch.
+    Returns a dict of user -> list of repo ids, extending the
+    lists in candidates when given.
+    """
+    if candidates is None:
+        candidates = {}
+
+    neighbors = {}
+    for user, watches in user_watches:
+        for watch in watches:
+            if watch not in neighbors:
+                neighbors[watch] = db.get_neighbors(watch)
+
+    logger.debug("Scoring {0} users over {1} watched repos".format(len(user_watches), len(neighbors)))
+
+    for user, watches in user_watches:
+        metrics.count('pairs_scanned', sum(len(neighbors[watch]) for watch in watches))
+        related_repos = [(watch, related, cofreq, prob)
+                         for watch in watches
+                         for related, cofreq, prob in neighbors[watch]
+                         if related not in watches]
+        select(related_repos, candidates.setdefault(user, []), n)
+
+    return candidates
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+Long running recommendation server.
+
+Loads the users, repos, frequencies, indexes and model once at
+startup and answers requests over a line protocol on a TCP
+socket. Each connection is handled in its own thread. Commands,
+one per line:
+
+    RECOMMEND <user>[,<user>...] [n]
+        One 'user:repo,repo,...' line per user, in request order.
+    STATS
+        One JSON line with request counts, throughput and
+        latency percentiles.
+    QUIT
+        Closes the connection.
+
+Errors are answered with a single 'ERROR <message>' line.
+"""
+
+from __future__ import division
+import analyzers
+import collections
+import config
+import logging
+import optparse
+import simplejson as json
+import SocketServer
+import threading
+import time
+
+logger = logging.getLogger("ghc.server")
+
+class RecommendationServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, n=10):
+        self.n = n
+        self.analysis = analyzers.Analysis()
+        # Loaded before listening, not by the first request
+        self.analysis.load()
+        self.db = self.analysis.open_reader()
+        # The reader and its neighbor cache are shared by
+        # every connection, so recommendations run one at a time.
+        self.lock = threading.Lock()
+        self.stats = Stats()
+        SocketServer.TCPServer.__init__(self, address, _Handler)
+        logger.info("Listening on {0}:{1}".format(*self.server_address))
+
+    def recommend(self, user_ids, n=None):
+        """
+        Returns (user, suggestions) pairs for each user id.
+        """
+        n = n or self.n
+        start = time.time()
+        with self.lock:
+            results = [(user, self.analysis.recommend(self.db, user, n)) for user in user_ids]
+        self.stats.record(len(user_ids), time.time() - start)
+        return results
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        self.db.close()
+
+class Stats:
+    """
+    Request counters and a window of recent request latencies.
+    """
+    def __init__(self, window=10000):
+        self.started = time.time()
+        self.requests = 0
+        self.users = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, users, seconds):
+        with self.lock:
+            self.requests += 1
+            self.users += users
+            self.latencies.append(seconds)
+
+    def summary(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            uptime = time.time() - self.started
+            summary = {
+                'requests': self.requests,
+                'users': self.users,
+                'uptime_seconds': uptime,
+                'requests_per_second': self.requests / uptime if uptime else 0,
+                'users_per_second': self.users / uptime if uptime else 0,
+                }
+
+        for percentile in (50, 90, 99):
+            key = 'latency_p{0}_ms'.format(percentile)
+            if latencies:
+                index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+                summary[key] = latencies[index] * 1000
+            else:
+                summary[key] = None
+
+        return summary
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            parts = line.split()
+            if not parts:
+                continue
+
+            command = parts[0].upper()
+            try:
+                if command == 'RECOMMEND':
+                    self._recommend(parts[1:])
+                elif command == 'STATS':
+                    self.wfile.write("{0}\n".format(json.dumps(self.server.stats.summary(), sort_keys=True)))
+                elif command == 'QUIT':
+                    break
+                else:
+                    self.wfile.write("ERROR unknown command {0}\n".format(parts[0]))
+            except ValueError, e:
+                self.wfile.write("ERROR {0}\n".format(e))
+            except Exception, e:
+                logger.exception("Failed to answer {0!r}".format(line.strip()))
+                self.wfile.write("ERROR {0}: {1}\n".format(e.__class__.__name__, e))
+            self.wfile.flush()
+
+    def _recommend(self, args):
+        if not args or len(args) > 2:
+            raise ValueError("usage: RECOMMEND <user>[,<user>...] [n]")
+
+        user_ids = [int(user) for user in args[0].split(',') if user]
+        n = int(args[1]) if len(args) == 2 else None
+        if n is not None and n <= 0:
+            raise ValueError("n must be positive")
+
+        for user, suggestions in self.server.recommend(user_ids, n):
+            self.wfile.write("{0}:{1}\n".format(user, ",".join(map(str, suggestions))))
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--host', default=config.SERVER_HOST,
+                      help="address to listen on")
+    parser.add_option('-p', '--port', type='int', default=config.SERVER_PORT,
+                      help="port to listen on")
+    parser.add_option('-n', type='int', default=10,
+                      help="default number of recommendations per user")
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, config.LOG_LEVEL),
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    server = RecommendationServer((options.host, options.port), options.n)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
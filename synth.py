@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+"""
+Seeded generator of synthetic contest data.
+
+Writes data.txt, repos.txt, lang.txt and test.txt in the contest
+formats, shaped like the 2009 dump: repo popularity and the
+number of watches per user follow power laws, forks form trees
+that can run many levels deep, and a few heavy watchers watch
+thousands of repos. A scale of 1 is about the size of the 2009
+dump. The same seed and parameters always give the same files.
+"""
+
+from __future__ import division
+import bisect
+import config
+import datetime
+import logging
+import optparse
+import os
+import os.path
+import random
+
+logger = logging.getLogger("ghc.synth")
+
+# Parameters at a scale of 1. Counts of users, repos and test
+# users are multiplied by the scale, the shapes are not.
+defaults = {
+    'users': 56554,
+    'repos': 120867,
+    'test_users': 4788,
+    # Pareto shape of the number of watches per user and Zipf
+    # exponent of repo popularity; heavier tails with a lower
+    # shape and a higher exponent
+    'watch_alpha': 1.0,
+    'popularity_exponent': 1.1,
+    'max_watches': 1000,
+    # Share of repos that are forks, and the chance that a fork
+    # is forked from another fork rather than from a root repo
+    'fork_share': 0.3,
+    'fork_chain': 0.5,
+    'max_fork_depth': 20,
+    # Chance that a watch goes to a relative of a repo the user
+    # already watches
+    'related_watches': 0.3,
+    # Share of users who watch heavy_watches repos each
+    'heavy_share': 0.0002,
+    'heavy_watches': 3000,
+    'language_share': 0.6,
+    }
+
+_languages = ['Ruby', 'JavaScript', 'Python', 'C', 'Shell', 'Perl', 'PHP',
+              'C++', 'Java', 'Emacs Lisp', 'Erlang', 'Haskell', 'Lua',
+              'Objective-C', 'Scheme', 'Common Lisp', 'VimL', 'ActionScript',
+              'Clojure', 'Scala', 'OCaml', 'Tcl', 'Smalltalk', 'Go']
+
+_words = ['rails', 'ruby', 'merb', 'sinatra', 'rack', 'django', 'py', 'jquery',
+          'js', 'emacs', 'vim', 'mode', 'dot', 'files', 'git', 'hub', 'tools',
+          'plugin', 'fu', 'app', 'blog', 'cms', 'api', 'client', 'server', 'db',
+          'sql', 'test', 'spec', 'mock', 'auth', 'cache', 'queue', 'parser',
+          'http', 'json', 'xml', 'yaml', 'config', 'deploy', 'cap', 'chef',
+          'web', 'feed', 'twitter', 'facebook', 'search', 'image', 'paperclip']
+
+_first_day = datetime.date(2007, 10, 20).toordinal()
+_last_day = datetime.date(2009, 8, 1).toordinal()
+
+def generate(out_dir, scale=1, seed=0, **params):
+    """
+    Writes the four raw data files into out_dir, which is created
+    if needed. params override the entries of defaults. Returns
+    a dict of the number of users, repos, watches, languages
+    and test users written.
+    """
+    for name in params:
+        if name not in defaults:
+            raise ValueError("Unknown parameter {0}".format(name))
+    p = dict(defaults, **params)
+
+    user_count = max(1, int(p['users'] * scale))
+    repo_count = max(1, int(p['repos'] * scale))
+    test_count = min(user_count, max(1, int(p['test_users'] * scale)))
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    rng = random.Random(seed)
+
+    logger.info("Generating {0} users and {1} repos in {2}".format(user_count, repo_count, out_dir))
+
+    parents = _write_repos(os.path.join(out_dir, 'repos.txt'), rng, repo_count, p)
+    languages = _write_languages(os.path.join(out_dir, 'lang.txt'), rng, parents, p)
+    watches, watchers = _write_watches(os.path.join(out_dir, 'data.txt'), rng,
+                                       user_count, parents, p)
+
+    test = open(os.path.join(out_dir, 'test.txt'), 'w')
+    try:
+        for user in rng.sample(watchers, min(test_count, len(watchers))):
+            test.write("{0}\n".format(user))
+    finally:
+        test.close()
+
+    counts = {'users': len(watchers), 'repos': repo_count, 'watches': watches,
+              'languages': languages, 'test_users': min(test_count, len(watchers))}
+    logger.info("Wrote {0[watches]} watches of {0[users]} users, {0[repos]} repos, "
+                "{0[languages]} language lines and {0[test_users]} test users".format(counts))
+    return counts
+
+def _write_repos(path, rng, repo_count, p):
+    """
+    Writes repos.txt and returns the parent id of each repo,
+    indexed by id, 0 for repos that are not forks. Ids are in
+    creation order, so a fork always comes after its parent.
+    """
+    parents = [0] * (repo_count + 1)
+    names = [None] * (repo_count + 1)
+    depths = [0] * (repo_count + 1)
+    days = [0] * (repo_count + 1)
+    roots = []
+    forks = []
+
+    owner_count = max(1, repo_count // 3)
+    span = _last_day - _first_day
+
+    out = open(path, 'w')
+    try:
+        for id in xrange(1, repo_count + 1):
+            day = _first_day + int(span * (id / repo_count) ** 0.5)
+
+            parent = 0
+            if roots and rng.random() < p['fork_share']:
+                if forks and rng.random() < p['fork_chain']:
+                    # Forks of recent forks make the deep chains
+                    parent = forks[-1 - min(len(forks) - 1, int(rng.paretovariate(1)) - 1)]
+                    if depths[parent] >= p['max_fork_depth']:
+                        parent = 0
+                if not parent:
+                    parent = roots[_zipf_index(rng, len(roots), p['popularity_exponent'])]
+
+            owner = _zipf_index(rng, owner_count, 1.2) + 1
+            if parent:
+                parents[id] = parent
+                depths[id] = depths[parent] + 1
+                forks.append(id)
+                names[id] = names[parent]
+                day = max(day, days[parent])
+                out.write("{0}:u{1}/{2},{3},{4}\n".format(
+                        id, owner, names[id], datetime.date.fromordinal(day), parent))
+            else:
+                roots.append(id)
+                names[id] = _name(rng)
+                out.write("{0}:u{1}/{2},{3}\n".format(
+                        id, owner, names[id], datetime.date.fromordinal(day)))
+            days[id] = day
+    finally:
+        out.close()
+
+    logger.debug("{0} forks, deepest fork tree {1} levels".format(len(forks), max(depths)))
+    return parents
+
+def _name(rng):
+    words = rng.sample(_words, 2)
+    return words[0] if rng.random() < 0.4 else "{0}-{1}".format(*words)
+
+def _write_languages(path, rng, parents, p):
+    """
+    Writes lang.txt for a share of the repos. Forks usually
+    have the languages of their parent.
+    """
+    weights = _cumulative([1 / (k + 1) for k in xrange(len(_languages))])
+    repo_languages = {}
+    lines = 0
+
+    out = open(path, 'w')
+    try:
+        for id in xrange(1, len(parents)):
+            parent = parents[id]
+            if parent in repo_languages and rng.random() < 0.9:
+                langs = repo_languages[parent]
+            elif rng.random() < p['language_share']:
+                langs = set(_languages[_pick(rng, weights)]
+                            for k in xrange(1 + int(rng.expovariate(1.5))))
+            else:
+                continue
+
+            repo_languages[id] = langs
+            out.write("{0}:{1}\n".format(id, ",".join(
+                        "{0};{1}".format(lang, int(rng.lognormvariate(8, 2)))
+                        for lang in sorted(langs))))
+            lines += 1
+    finally:
+        out.close()
+
+    return lines
+
+def _write_watches(path, rng, user_count, parents, p):
+    """
+    Writes data.txt. Each user watches a power law number of
+    repos picked by a power law of popularity, some of them
+    relatives of repos already watched. Returns the number of
+    watches and the ids of the users with any.
+    """
+    repo_count = len(parents) - 1
+    children = {}
+    for id in xrange(1, repo_count + 1):
+        if parents[id]:
+            children.setdefault(parents[id], []).append(id)
+
+    # Popularity ranks are shuffled so that old repos are not
+    # always the most watched
+    ranked = range(1, repo_count + 1)
+    rng.shuffle(ranked)
+    heavy = set(rng.sample(xrange(1, user_count + 1), int(user_count * p['heavy_share'])))
+
+    watches = 0
+    watchers = []
+
+    out = open(path, 'w')
+    try:
+        for user in xrange(1, user_count + 1):
+            if user in heavy:
+                count = p['heavy_watches']
+            else:
+                count = min(p['max_watches'], int(rng.paretovariate(p['watch_alpha'])))
+            count = min(count, repo_count)
+
+            watched = []
+            seen = set()
+            for attempt in xrange(count * 3):
+                if len(watched) == count:
+                    break
+                if watched and rng.random() < p['related_watches']:
+                    repo = _relative(rng, rng.choice(watched), parents, children)
+                else:
+                    repo = ranked[_zipf_index(rng, repo_count, p['popularity_exponent'])]
+                if repo and repo not in seen:
+                    seen.add(repo)
+                    watched.append(repo)
+
+            for repo in watched:
+                out.write("{0}:{1}\n".format(user, repo))
+            watches += len(watched)
+            if watched:
+                watchers.append(user)
+    finally:
+        out.close()
+
+    logger.debug("{0} heavy watchers".format(len(heavy)))
+    return watches, watchers
+
+def _relative(rng, repo, parents, children):
+    if parents[repo] and (repo not in children or rng.random() < 0.5):
+        return parents[repo]
+    if repo in children:
+        return rng.choice(children[repo])
+    return 0
+
+def _zipf_index(rng, count, exponent):
+    """
+    Picks an index in [0, count), index k with a probability
+    roughly proportional to 1 / (k + 1) ** exponent.
+    """
+    if exponent == 1:
+        x = count ** rng.random()
+    else:
+        x = ((count ** (1 - exponent) - 1) * rng.random() + 1) ** (1 / (1 - exponent))
+    return min(count, int(x)) - 1
+
+def _cumulative(weights):
+    total = 0
+    cumulative = []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return cumulative
+
+def _pick(rng, cumulative):
+    return bisect.bisect(cumulative, rng.random() * cumulative[-1])
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [name=value ...]",
+                                   description="Writes synthetic raw data files. "
+                                   "Parameters: " + ", ".join(sorted(defaults)))
+    parser.add_option('-o', '--out', default=config.SRC_DATA_PATH,
+                      help="directory to write the files to")
+    parser.add_option('-x', '--scale', type='float', default=1,
+                      help="size relative to the 2009 dump")
+    parser.add_option('-s', '--seed', type='int', default=0)
+    options, args = parser.parse_args()
+
+    params = {}
+    for arg in args:
+        name, value = arg.split('=', 1)
+        if name not in defaults:
+            parser.error("Unknown parameter {0}".format(name))
+        params[name] = type(defaults[name])(value)
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    generate(options.out, options.scale, options.seed, **params)
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,90 @@
+from __future__ import division
+import array
 import collections
 import config
+import csr
+import heapq
+import ingest
+import itertools
 import logging
+import metrics
+import os
 import os.path
 import pytc
+import scoring
+import struct
+import tempfile
 import users
+import util
 
 logger = logging.getLogger("ghc.tokyo")
 
+def database_path():
+    return os.path.join(config.CALC_DATA_PATH, 'cprob.tch')
+
 def database_exists():
-    return os.path.exists(os.path.join(config.CALC_DATA_PATH, 'cprob.tch'))
+    return os.path.exists(database_path())
 
-def compute_conditional_probabilities():
-    logger.debug("Computing conditional probabilities.")
+def database_is_fresh():
+    """
+    Checks that cprob.tch was built from the current data.txt
+    with the current model settings.
+    """
+    return util.is_fresh(database_path(), [ingest.data_path()], _settings())
 
-    user_watches = users.get_user_watches()
-    repo_frequencies = users.get_repo_frequencies()
+def _settings():
+    """
+    The config settings that change the records of the model.
+    """
+    return {'MODEL_EPSILON': config.MODEL_EPSILON,
+            'MODEL_TOP_K': config.MODEL_TOP_K,
+            'HEAVY_WATCHER_POLICY': config.HEAVY_WATCHER_POLICY,
+            'HEAVY_WATCHER_LIMIT': config.HEAVY_WATCHER_LIMIT,
+            'HEAVY_WATCHER_SEED': config.HEAVY_WATCHER_SEED}
+
+def compute_conditional_probabilities(engine=None):
+    """
+    Computes the conditional probability of every co-watched
+    pair of repos and persists them to Tokyo Cabinet.
+
+    The engine defaults to config.MODEL_ENGINE. 'python' counts
+    pairs one watchlist at a time, 'sparse' builds a user x repo
+    incidence matrix and counts every pair with one sparse
+    product and 'external' keeps memory bounded by merging
+    sorted runs from disk. All of them persist exactly the
+    same records.
+
+    Pairs are counted over users.get_model_watches, with the
+    heavy watcher policy applied, and re-weighted when the
+    policy down-weights heavy watchers. Pairs below
+    config.MODEL_EPSILON are dropped and, with
+    config.MODEL_TOP_K, only the best neighbors of each repo
+    are kept. The data.txt and settings the model was built
+    from are recorded in its manifest. Returns the pruning
+    report of _persist_pairs.
+    """
+    engine = engine or config.MODEL_ENGINE
+
+    if engine not in _engines:
+        raise ValueError("Unknown model engine {0}".format(engine))
+
+    logger.debug("Computing conditional probabilities with the {0} engine.".format(engine))
+
+    pairs = _engines[engine]()
+    if users.get_watch_weights():
+        pairs = _weight_pairs(pairs)
+
+    report = _persist_pairs(pairs)
+    util.write_manifest(database_path(), [ingest.data_path()], _settings())
+    return report
+
+def _python_pairs():
+    """
+    Counts co-occurrences with a pure Python double loop over
+    each watchlist. Yields (i, j, cofreq, prob) tuples.
+    """
+    user_watches = users.get_model_watches()
+    repo_frequencies = users.get_model_frequencies()
 
     # Prune watchlists to only those w/ greater than 1 watch
     watches_list = [w for w in user_watches.values() if len(w) > 1]
@@ -24,23 +94,332 @@ def compute_conditional_probabilities():
 
     cprob = collections.defaultdict(dict)
 
+    debug = logger.isEnabledFor(logging.DEBUG)
     count = 0
     for watches in watches_list:
         count += 1
-        logger.debug("Processing watch {0} of {1}".format(count, watches_size))
+        if debug:
+            logger.debug("Processing watch {0} of {1}".format(count, watches_size))
+        metrics.count('pairs_counted', len(watches) * (len(watches) - 1))
         
         for i in watches:
             for j in watches:
                 if i == j: continue
 
                 if not j in cprob[i]:
-                    cprob[i][j] = 1, 1/repo_frequencies[i]
+                    cprob[i][j] = 1, 1/repo_frequencies[i][0]
                 else:
                     cofreq = cprob[i][j][0] + 1
-                    cprob[i][j] = cofreq, cofreq/repo_frequencies[i]
+                    cprob[i][j] = cofreq, cofreq/repo_frequencies[i][0]
+
+    return _iter_cprobs(cprob)
+
+def _sparse_pairs():
+    """
+    Counts co-occurrences in bulk. With A as the binary user x repo
+    incidence matrix, A'A holds the co-frequency of every pair of
+    repos. Yields (i, j, cofreq, prob) tuples one row at a time.
+    """
+    try:
+        import numpy
+        import scipy.sparse
+    except ImportError:
+        raise ImportError("The sparse engine requires numpy and scipy")
+
+    user_watches = users.get_model_watches()
+    repo_frequencies = users.get_model_frequencies()
+
+    rows = []
+    cols = []
+    for row, watches in enumerate(user_watches.itervalues()):
+        rows.extend([row] * len(watches))
+        cols.extend(watches)
+
+    logger.debug("Building {0} x {1} incidence matrix with {2} watches".format(
+            len(user_watches), max(cols) + 1, len(cols)))
+
+    incidence = scipy.sparse.csr_matrix(
+        (numpy.ones(len(cols), dtype=numpy.int32), (rows, cols)),
+        shape=(len(user_watches), max(cols) + 1))
+
+    # Drop the diagonal, a repo is not co-watched with itself
+    cofreqs = (incidence.T * incidence).tocoo()
+    pairs = cofreqs.row != cofreqs.col
+    cofreqs = scipy.sparse.csr_matrix(
+        (cofreqs.data[pairs], (cofreqs.row[pairs], cofreqs.col[pairs])),
+        shape=cofreqs.shape)
+
+    logger.debug("Counted {0} co-occurring pairs".format(cofreqs.nnz))
+
+    return _iter_cofreq_matrix(cofreqs, repo_frequencies)
+
+def _iter_cofreq_matrix(cofreqs, repo_frequencies):
+    """
+    Walks a CSR co-frequency matrix and divides each row
+    by the frequency of its repo in one array operation.
+    """
+    indptr, indices, data = cofreqs.indptr, cofreqs.indices, cofreqs.data
+
+    for i in xrange(cofreqs.shape[0]):
+        start, end = indptr[i], indptr[i + 1]
+        if start == end:
+            continue
+
+        freq = repo_frequencies[i][0]
+        counts = data[start:end]
+        probs = counts / freq
+
+        for j, cofreq, prob in zip(indices[start:end].tolist(), counts.tolist(), probs.tolist()):
+            yield i, j, cofreq, prob
+
+# Rough cost of one (i, j) -> count entry in a dict, used to turn
+# config.MODEL_BUILD_MEMORY_MB into a number of pairs.
+_PAIR_BYTES = 120
+
+# Rough memory taken by the user -> watches sets grouped from one
+# byte of data.txt, used to size the watch buckets
+_GROUPED_BYTES = 8
+
+# A spilled run is a sorted sequence of (i, j, count) records
+_run_record = struct.Struct('<iii')
 
-    persist_conditional_probabilities(cprob)
+def _external_pairs(memory_mb=None):
+    """
+    Counts co-occurrences with bounded memory. data.txt is
+    streamed into bucket files by user id, so that one bucket's
+    watchlists fit in half the memory ceiling, and the buckets
+    are counted one at a time. Counts are spilled to a temp file
+    under config.CALC_DATA_PATH as a sorted run of (i, j, count)
+    records whenever they reach the ceiling, even in the middle
+    of a watchlist. A k-way merge of the runs sums the partial
+    counts. Yields (i, j, cofreq, prob) tuples ordered by (i, j).
+
+    The repo frequencies are counted along the way and cached
+    with users.store_repo_frequencies, so nothing loads every
+    watch at once. The 'weight' policy still does, to re-weight
+    the pairs of the heavy watchers.
+    """
+    memory_mb = memory_mb or config.MODEL_BUILD_MEMORY_MB
+    max_pairs = max(1, memory_mb * 1024 * 1024 // _PAIR_BYTES)
+    policy = config.HEAVY_WATCHER_POLICY
+
+    logger.debug("Counting pairs in chunks of at most {0} pairs".format(max_pairs))
+
+    buckets = _partition_watches(memory_mb)
+    runs = []
+    try:
+        watchers = collections.defaultdict(int)
+        repo_frequencies = None
+        if policy == 'cap':
+            # Capping keeps the most watched repos, so popularity
+            # takes a pass of its own
+            for user, watches in _read_buckets(buckets):
+                for repo in watches:
+                    watchers[repo] += 1
+            repo_frequencies = users.store_repo_frequencies(watchers)
+
+        # Watchers of each repo in the model watchlists. Under
+        # 'weight' these are plain counts; _weight_pairs redoes
+        # the probabilities with the weighted ones.
+        model_watchers = collections.defaultdict(int)
+        heavy = []
+        removed = 0
+
+        counts = {}
+        for user, watches in _read_buckets(buckets):
+            if policy != 'cap':
+                for repo in watches:
+                    watchers[repo] += 1
+
+            kept = users.model_watchlist(user, watches, repo_frequencies)
+            if len(kept) < len(watches):
+                heavy.append(user)
+                removed += len(watches) * (len(watches) - 1) - len(kept) * (len(kept) - 1)
+
+            for repo in kept:
+                model_watchers[repo] += 1
+            if len(kept) < 2:
+                continue
+
+            for i in kept:
+                for j in kept:
+                    if i == j: continue
+                    key = i, j
+                    counts[key] = counts.get(key, 0) + 1
+
+                if len(counts) >= max_pairs:
+                    runs.append(_spill_run(counts))
+                    counts = {}
+
+        if policy != 'cap':
+            users.store_repo_frequencies(watchers)
+        if policy in ('cap', 'sample'):
+            users.log_policy(policy, heavy, removed)
+        watchers = None
+
+        if runs:
+            if counts:
+                runs.append(_spill_run(counts))
+            counts = None
+            merged = _merge_runs(runs)
+        else:
+            merged = ((i, j, count) for (i, j), count in sorted(counts.iteritems()))
+
+        for i, j, cofreq in merged:
+            yield i, j, cofreq, cofreq/model_watchers[i]
+
+    finally:
+        for path in runs + buckets:
+            os.remove(path)
+
+def _partition_watches(memory_mb):
+    """
+    Streams data.txt into bucket files of (user, repo) records,
+    split by user id, each small enough to group in half of
+    memory_mb. Returns the paths of the buckets.
+    """
+    path = ingest.data_path()
+    count = 1 + os.path.getsize(path) * _GROUPED_BYTES // (memory_mb * 1024 * 1024 // 2)
 
+    logger.debug("Partitioning {0} into {1} buckets".format(path, count))
+
+    paths = []
+    files = []
+    try:
+        for k in xrange(count):
+            fd, bucket = tempfile.mkstemp(prefix='watches-', suffix='.bucket',
+                                          dir=config.CALC_DATA_PATH)
+            paths.append(bucket)
+            files.append(os.fdopen(fd, 'wb'))
+
+        for user_ids, repo_ids in ingest.iter_watches(path):
+            records = [array.array('i') for k in xrange(count)]
+            for user, repo in itertools.izip(user_ids, repo_ids):
+                record = records[user % count]
+                record.append(user)
+                record.append(repo)
+            for bucket, record in zip(files, records):
+                record.tofile(bucket)
+    except:
+        for bucket in paths:
+            os.remove(bucket)
+        raise
+    finally:
+        for bucket in files:
+            bucket.close()
+
+    return paths
+
+def _read_buckets(paths):
+    """
+    Yields the (user, watched repo ids) of every user, one
+    bucket of users in memory at a time.
+    """
+    for path in paths:
+        records = array.array('i')
+        bucket = open(path, 'rb')
+        try:
+            records.fromfile(bucket, os.path.getsize(path) // records.itemsize)
+        finally:
+            bucket.close()
+
+        user_watches = ingest.group_watches(records[0::2], records[1::2])
+        records = None
+        for user in sorted(user_watches):
+            yield user, user_watches[user]
+
+def _spill_run(counts):
+    """
+    Writes a dict of (i, j) -> count to a sorted run file
+    and returns its path.
+    """
+    fd, path = tempfile.mkstemp(prefix='cprob-', suffix='.run',
+                                dir=config.CALC_DATA_PATH)
+    out = os.fdopen(fd, 'wb')
+
+    try:
+        logger.debug("Spilling {0} pairs to {1}".format(len(counts), path))
+        pack = _run_record.pack
+        for (i, j), count in sorted(counts.iteritems()):
+            out.write(pack(i, j, count))
+    finally:
+        out.close()
+
+    return path
+
+def _read_run(path, records=8192):
+    """
+    Yields the (i, j, count) records of a run file,
+    reading a block of records at a time.
+    """
+    size = _run_record.size
+    unpack_from = _run_record.unpack_from
+
+    run = open(path, 'rb')
+    try:
+        while True:
+            block = run.read(size * records)
+            if not block:
+                break
+            for offset in xrange(0, len(block), size):
+                yield unpack_from(block, offset)
+    finally:
+        run.close()
+
+def _merge_runs(paths):
+    """
+    Merges sorted run files, summing the counts of each pair.
+    """
+    logger.debug("Merging {0} runs".format(len(paths)))
+
+    merged = heapq.merge(*[_read_run(path) for path in paths])
+
+    for (i, j), records in itertools.groupby(merged, key=lambda r: (r[0], r[1])):
+        yield i, j, sum(r[2] for r in records)
+
+def _weight_pairs(pairs):
+    """
+    Re-weights (i, j, cofreq, prob) tuples, grouped by i, for
+    down-weighted heavy watchers. Each of them counts for their
+    weight rather than 1 in the cofrequency the probability is
+    computed from; the stored cofreq stays the number of users
+    watching both repos. The weight missing from each pair of a
+    row is summed from the heavy watchers of that row's repo.
+    """
+    user_watches = users.get_user_watches()
+    weights = users.get_watch_weights()
+    repo_frequencies = users.get_model_frequencies()
+
+    heavy_watchers = collections.defaultdict(list)
+    for user, weight in weights.iteritems():
+        for repo in user_watches[user]:
+            heavy_watchers[repo].append((user_watches[user], 1 - weight))
+
+    for i, row in itertools.groupby(pairs, lambda pair: pair[0]):
+        missing = collections.defaultdict(float)
+        for watches, discount in heavy_watchers.get(i, ()):
+            for j in watches:
+                missing[j] += discount
+
+        freq = repo_frequencies[i][0]
+        for i, j, cofreq, cprob in row:
+            yield i, j, cofreq, (cofreq - missing.get(j, 0)) / freq
+
+def _iter_cprobs(cprobs):
+    """
+    Flattens a conditional probability dict of the form
+    {i: {j: (cofreq, prob)}} into (i, j, cofreq, prob) tuples.
+    """
+    for i in cprobs:
+        for j in cprobs[i]:
+            cfreq, cprob = cprobs[i][j]
+            yield i, j, cfreq, cprob
+
+_engines = {
+    'python': _python_pairs,
+    'sparse': _sparse_pairs,
+    'external': _external_pairs,
+    }
 
 def persist_conditional_probabilities(cprobs):
     """
@@ -49,62 +428,251 @@ def persist_conditional_probabilities(cprobs):
     'freq,prob' where 'freq' is the # of times j was seen with
     i and 'prob' is the percentage of time j occurs with i.
     """
-    epsilon = 0.001
-    db_path = os.path.join(config.CALC_DATA_PATH, 'cprob.tch')
+    return _persist_pairs(_iter_cprobs(cprobs))
+
+def _persist_pairs(pairs, epsilon=None, top_k=None):
+    """
+    Persists (i, j, cofreq, prob) tuples, grouped by i, to Tokyo
+    Cabinet. Pairs below the probability threshold are skipped
+    and, with top_k, only the top_k neighbors of each repo by
+    scoring.weight are kept.
+
+    Logs and returns a report of the model size and of the
+    average scan length per watched repo, before and after
+    top_k pruning. Scan lengths are weighted by how many users
+    watch each repo, since that is how often a row is read.
+    """
+    epsilon = config.MODEL_EPSILON if epsilon is None else epsilon
+    top_k = config.MODEL_TOP_K if top_k is None else top_k
+
+    db_path = database_path()
     db = pytc.BDB()
     db.open(db_path, pytc.BDBOWRITER | pytc.BDBOCREAT)
 
     logger.debug("Persisting probabilities to {0}".format(db_path))
-    
+
+    report = dict(pairs=0, above_epsilon=0, kept=0, rows=0,
+                  watches=0, scan_before=0, scan_after=0)
+    # (repo, row length before and after pruning) of each row,
+    # weighted once the pairs are written. The external engine
+    # only counts the repo frequencies as it goes.
+    rows = array.array('i')
     try:
-        for i in cprobs:
-            for j in cprobs[i]:
-                if i == j:
-                    continue
+        for i, row in itertools.groupby(pairs, lambda pair: pair[0]):
+            row = [(j, cfreq, cprob) for i_, j, cfreq, cprob in row if i_ != j]
+            report['pairs'] += len(row)
+
+            row = [pair for pair in row if cmp(pair[2], epsilon) >= 0]
+            before = len(row)
+            row = _prune_row(row, top_k)
 
-                cfreq, cprob = cprobs[i][j]
+            for j, cfreq, cprob in row:
+                db.put(*_format_pair(i, j, cfreq, cprob))
 
-                if cmp(cprob, epsilon) < 0:
-                    continue
+            report['rows'] += 1
+            report['above_epsilon'] += before
+            report['kept'] += len(row)
+            rows.extend((i, before, len(row)))
 
-                db.put("{0},{1}".format(i,j), 
-                       "{0},{1:.4f}".format(cfreq, cprob))
-            
     finally:
         db.close()
         logger.debug("Wrote probabilities to {0}".format(db_path))
 
+    repo_frequencies = users.get_repo_frequencies()
+    for k in xrange(0, len(rows), 3):
+        i, before, after = rows[k:k + 3]
+        freq = repo_frequencies[i][0] if i in repo_frequencies else 0
+        report['watches'] += freq
+        report['scan_before'] += freq * before
+        report['scan_after'] += freq * after
+
+    report['bytes'] = os.path.getsize(db_path)
+    _log_pruning(report, epsilon, top_k)
+    return report
+
+def _prune_row(row, top_k):
+    """
+    Keeps the top_k (j, cofreq, prob) tuples of a row by the
+    weight of the probability as stored, ties going to the
+    lower repo id.
+    """
+    if not top_k or len(row) <= top_k:
+        return row
+    return heapq.nsmallest(top_k, row, key=lambda (j, cfreq, cprob):
+                           (-scoring.weight(cfreq, round(cprob, 4)), j))
+
+def _log_pruning(report, epsilon, top_k):
+    watches = report['watches'] or 1
+    logger.info("Model pairs: {0} counted, {1} above epsilon {2}, {3} kept{4}".format(
+            report['pairs'], report['above_epsilon'], epsilon, report['kept'],
+            " with top {0}".format(top_k) if top_k else ""))
+    logger.info("Model size: {0} repos, {1} bytes".format(report['rows'], report['bytes']))
+    logger.info("Average scan length per watched repo: {0:.1f} before, {1:.1f} after pruning".format(
+            report['scan_before'] / watches, report['scan_after'] / watches))
+
+def _format_pair(i, j, cfreq, cprob):
+    return "{0},{1}".format(i,j), "{0},{1:.4f}".format(cfreq, cprob)
+
+def update_conditional_probabilities(lines):
+    """
+    Applies a batch of new 'user:repo' watch lines to the stored
+    model without recomputing it from scratch.
+
+    Every repo that gained a watcher has a new frequency, so its
+    whole row is recounted from the watchlists of its watchers and
+    re-normalized. For the other repos the new user watches, only
+    the single entry pointing at the newly watched repo changes;
+    its cofrequency is the overlap of the two repos' watchers.
+    Epsilon pruning is applied to every rewritten value. With
+    config.MODEL_TOP_K, a new entry can push another one out of
+    its row, so every affected row is recounted and pruned as a
+    whole instead. A heavy watcher policy can reshape whole
+    watchlists, so with one set the model is rebuilt. Returns
+    the set of repos whose rows changed.
+
+    A cprob.csr converted from the old model is removed, so
+    that it gets converted again from the updated one.
+    """
+    stale = not database_is_fresh()
+    added = users.add_watches(lines)
+    if not added:
+        return set()
+
+    if stale or config.HEAVY_WATCHER_POLICY:
+        logger.debug("Rebuilding the model, it is stale or under a heavy watcher policy")
+        _remove_csr()
+        os.remove(database_path())
+        compute_conditional_probabilities()
+        return set(users.get_repo_frequencies())
+
+    user_watches = users.get_user_watches()
+    repo_watchers = users.get_repo_watchers()
+    repo_frequencies = users.get_repo_frequencies()
+
+    epsilon = config.MODEL_EPSILON
+    top_k = config.MODEL_TOP_K
+
+    recount = set(repo for user, repo in added)
+    entries = set()
+    for user, repo in added:
+        for watch in user_watches[user]:
+            if watch != repo and watch not in recount:
+                entries.add((watch, repo))
+
+    if top_k:
+        recount.update(i for i, j in entries)
+        entries = set()
+
+    logger.debug("Recounting {0} rows and {1} entries".format(len(recount), len(entries)))
+
+    db_path = database_path()
+    db = pytc.BDB()
+    db.open(db_path, pytc.BDBOWRITER | pytc.BDBOCREAT)
+
+    try:
+        for i in recount:
+            for key in db.rangefwm("{0},".format(i), 1000000):
+                db.out(key)
+
+            cofreqs = collections.defaultdict(int)
+            for user in repo_watchers[i]:
+                for j in user_watches[user]:
+                    if j != i:
+                        cofreqs[j] += 1
+
+            freq = repo_frequencies[i][0]
+            row = [(j, cfreq, cfreq/freq) for j, cfreq in cofreqs.iteritems()
+                   if cmp(cfreq/freq, epsilon) >= 0]
+            for j, cfreq, cprob in _prune_row(row, top_k):
+                db.put(*_format_pair(i, j, cfreq, cprob))
+
+        for i, j in entries:
+            cfreq = len(repo_watchers[i] & repo_watchers[j])
+            cprob = cfreq/repo_frequencies[i][0]
+            key, value = _format_pair(i, j, cfreq, cprob)
+            if cmp(cprob, epsilon) >= 0:
+                db.put(key, value)
+            else:
+                try:
+                    db.out(key)
+                except KeyError:
+                    pass
+
+    finally:
+        db.close()
+        logger.debug("Updated probabilities in {0}".format(db_path))
+
+    util.write_manifest(db_path, [ingest.data_path()], _settings())
+    _remove_csr()
+
+    return recount | set(i for i, j in entries)
+
+def _remove_csr():
+    # A CSR conversion of the old model is now out of date
+    if csr.database_exists():
+        logger.debug("Removing stale {0}".format(csr.database_path()))
+        os.remove(csr.database_path())
+
 
 class Reader:
-    def __init__(self):
+    """
+    Reads related repos out of cprob.tch. Parsed neighbor lists
+    are kept in an LRU cache keyed by repo id. Pass the same
+    util.LRUCache to several readers to share it between them.
+    """
+    def __init__(self, cache=None):
         self.db = pytc.BDB()
-        self.db.open(os.path.join(config.CALC_DATA_PATH, 'cprob.tch'),
+        self.db.open(database_path(),
                      pytc.BDBOREADER)
+        self.cache = cache if cache is not None else util.LRUCache(config.NEIGHBOR_CACHE_SIZE)
+
+
+    def prewarm(self, n=None):
+        """
+        Loads the neighbor lists of the n most frequently
+        watched repos into the cache.
+        """
+        n = config.NEIGHBOR_CACHE_PREWARM if n is None else n
+        n = min(n, self.cache.size)
+        if n <= 0:
+            return
+
+        repo_freqs = users.get_repo_frequencies()
+        popular = heapq.nlargest(n, repo_freqs, key=lambda r: repo_freqs[r][0])
+
+        logger.debug("Prewarming neighbor cache with {0} repos".format(len(popular)))
+
+        for repo in popular:
+            if repo not in self.cache:
+                self.cache.put(repo, self._read_neighbors(repo))
+
+
+    def get_neighbors(self, repo):
+        """
+        Returns the (related_repo_id, cofrequency, conditional_probability)
+        tuples stored for a repo.
+        """
+        return scoring.cached_neighbors(self.cache, repo, self._read_neighbors)
+
+
+    def _read_neighbors(self, repo):
+        metrics.count('db_lookups')
+        neighbors = []
+        for pair in self.db.rangefwm("{0},".format(repo), 1000000):
+            cofreq, cprob = self.db.get(pair).split(',')
+            neighbors.append((int(pair.split(',')[1]), int(cofreq), float(cprob)))
+        return neighbors
 
 
     def get_related_repos(self, user_watches):
         """
-        Returns a dict where the keys are the watched repos,
-        and the values are a list of tuples:
+        Returns a list of tuples:
         (watch, related_repo_id, cofrequency, conditional_probability)
         """
-        related_repos = list()
-
-        logger.debug("Retrieving related repos for {0} watches".format(len(user_watches)))
-
-        for watch in user_watches:
-            for pair in self.db.rangefwm("{0},".format(watch), 1000000):
-                related = int(pair.split(',')[1])
-                # Don't add any repos already being watched
-                if related in user_watches:
-                    continue
-                cofreq, cprob = self.db.get(pair).split(',')
-                related_repos.append((watch, related, int(cofreq), float(cprob)))
-
-        logger.debug("Retrieved {0} related repos".format(len(related_repos)))
-        return related_repos
-                
-            
+        return scoring.related_repos(self, user_watches)
+
+
     def close(self):
         self.db.close()
+        logger.debug("Neighbor cache: {0} hits, {1} misses".format(self.cache.hits, self.cache.misses))
         
@@ -1,8 +1,12 @@
 from __future__ import division
 import collections
 import config
+import ingest
+import itertools
 import logging
+import metrics
 import os.path
+import random
 import util
 
 logger = logging.getLogger("ghc.users")
@@ -40,8 +44,40 @@ class User:
                 '__languages': self.languages, 
                 }, sort_keys=True, indent=2)
 
+class RepoFrequencies(object):
+    """
+    Map of repo id to (frequency, relative_freq) tuples. Only the
+    frequencies and their total are stored, the relative frequency
+    is derived on each read, so that changing the frequency of a
+    repo does not touch every other one.
+    """
+    def __init__(self, counts=None):
+        self.counts = counts if counts is not None else {}
+        self.total = sum(self.counts.itervalues())
+
+    def __getitem__(self, repo):
+        freq = self.counts[repo]
+        return freq, freq/self.total
+
+    def __contains__(self, repo):
+        return repo in self.counts
+
+    def __iter__(self):
+        return iter(self.counts)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def set(self, repo, freq):
+        self.total += freq - self.counts.get(repo, 0)
+        self.counts[repo] = freq
+
 _user_watches = None
 _repo_freqs = None
+_model_freqs = None
+_repo_watchers = None
+_model_watches = None
+_watch_weights = None
 _test_ids = None
 
 def get_user_watches():
@@ -50,54 +86,344 @@ def get_user_watches():
     of repo ids being watched by that user
     """
     path = os.path.join(config.CALC_DATA_PATH, 'user_watches.pickle')
+    sources = [_data_path()]
     global _user_watches
-    user_watches = _user_watches or util.load_pickle(path)
+    user_watches = _user_watches or _load_cache(path, _replay_user_watches)
     if user_watches:
         _user_watches = user_watches
         return user_watches
     
-    user_watches = collections.defaultdict(set)
-    
-    for line in open(os.path.join(config.SRC_DATA_PATH, 'data.txt')):
-        k,v = line.rstrip().split(':')
-        user_watches[int(k)].add(int(v))
+    user_watches = ingest.group_watches(*ingest.read_watches(_data_path()))
 
-    util.store_pickle(user_watches, path, debug=True)
+    util.store_cache(user_watches, path, sources)
     _user_watches = user_watches
 
     return user_watches
 
+def get_model_watches():
+    """
+    Returns the user watches the model is counted from. With
+    config.HEAVY_WATCHER_POLICY set to 'cap', watchlists longer
+    than config.HEAVY_WATCHER_LIMIT keep only their most watched
+    repos; with 'sample', a random sample of them seeded with
+    config.HEAVY_WATCHER_SEED and the user id. Otherwise these
+    are the user watches.
+    """
+    global _model_watches
+    if _model_watches is not None:
+        return _model_watches
+
+    user_watches = get_user_watches()
+    policy = config.HEAVY_WATCHER_POLICY
+    if policy not in _policies:
+        raise ValueError("Unknown heavy watcher policy {0}".format(policy))
+
+    if policy not in ('cap', 'sample'):
+        _model_watches = user_watches
+        return user_watches
+
+    limit = config.HEAVY_WATCHER_LIMIT
+    heavy = [user for user, watches in user_watches.iteritems() if len(watches) > limit]
+    repo_frequencies = get_repo_frequencies() if policy == 'cap' else None
+
+    model_watches = collections.defaultdict(set, user_watches)
+    removed = 0
+    for user in heavy:
+        model_watches[user] = model_watchlist(user, user_watches[user], repo_frequencies)
+        removed += _pairs(len(user_watches[user])) - _pairs(limit)
+
+    log_policy(policy, heavy, removed)
+    _model_watches = model_watches
+    return model_watches
+
+def model_watchlist(user, watches, repo_frequencies=None):
+    """
+    Applies the 'cap' or 'sample' heavy watcher policy to the
+    watches of one user, as get_model_watches does. Watchlists
+    within the limit, and every watchlist under the other
+    policies, are returned as they are. 'cap' ranks by the given
+    repo frequencies, get_repo_frequencies by default.
+    """
+    policy = config.HEAVY_WATCHER_POLICY
+    limit = config.HEAVY_WATCHER_LIMIT
+    if policy not in ('cap', 'sample') or len(watches) <= limit:
+        return watches
+
+    watches = sorted(watches)
+    if policy == 'cap':
+        repo_frequencies = repo_frequencies or get_repo_frequencies()
+        kept = sorted(watches, key=lambda repo: (-repo_frequencies[repo][0], repo))[:limit]
+    else:
+        kept = random.Random((config.HEAVY_WATCHER_SEED, user)).sample(watches, limit)
+    return set(kept)
+
+def get_watch_weights():
+    """
+    Returns a dict of user id keys mapped to the weight of each
+    of their watches in the model. With config.HEAVY_WATCHER_POLICY
+    set to 'weight', watchlists longer than HEAVY_WATCHER_LIMIT
+    are weighted by HEAVY_WATCHER_LIMIT / len(watchlist); everyone
+    else is left out and weighs 1.
+    """
+    global _watch_weights
+    if _watch_weights is not None:
+        return _watch_weights
+
+    weights = {}
+    if config.HEAVY_WATCHER_POLICY == 'weight':
+        limit = config.HEAVY_WATCHER_LIMIT
+        removed = 0
+        for user, watches in get_user_watches().iteritems():
+            if len(watches) > limit:
+                weights[user] = limit / len(watches)
+                removed += _pairs(len(watches)) * (1 - weights[user])
+        log_policy('weight', weights, removed)
+
+    _watch_weights = weights
+    return weights
+
+# Policies for watchlists longer than config.HEAVY_WATCHER_LIMIT
+_policies = (None, 'cap', 'sample', 'weight')
+
+def _pairs(watches):
+    return watches * (watches - 1)
+
+def log_policy(policy, heavy, removed):
+    """
+    Logs and counts the pairs a heavy watcher policy removed
+    from the watchlists of the heavy watchers.
+    """
+    logger.info("Heavy watcher policy '{0}' removed {1:.0f} pairs from {2} watchlists over {3} repos".format(
+            policy, removed, len(heavy), config.HEAVY_WATCHER_LIMIT))
+    metrics.count('heavy_watcher_pairs_removed', removed)
+
 def get_repo_frequencies():
     """
-    Returns a map of repo id to (frequency, relative_freq) tuples.
+    Returns a RepoFrequencies map of repo id to (frequency,
+    relative_freq) tuples, counted over every user's watches.
+    This is the popularity the fill tiers, indexes and blend
+    rank by, whatever the heavy watcher policy.
     """
-    path = os.path.join(config.CALC_DATA_PATH, 'repo_frequencies1.pickle')
+    path = repo_frequencies_path()
+    sources = [_data_path()]
     global _repo_freqs
-    repo_frequencies = _repo_freqs or util.load_pickle(path)
+    repo_frequencies = _repo_freqs or _load_cache(path, _replay_repo_frequencies)
     if repo_frequencies:
         _repo_freqs = repo_frequencies
         return repo_frequencies
 
-    user_watches = get_user_watches()
+    repo_frequencies = _count_frequencies(get_user_watches(), {})
 
-    total_watches = sum(len(w) for w in user_watches.values())
-    logger.debug("Total watches is {0}".format(total_watches))
-    
-    repo_frequencies = dict()
-    for repos in user_watches.values():
-        for watch in repos:
-            if not watch in repo_frequencies:
-                repo_frequencies[watch] = (1, 1/total_watches)
-            else:
-                freq = repo_frequencies[watch][0] + 1
-                repo_frequencies[watch] = (freq, freq/total_watches)
+    util.store_cache(repo_frequencies, path, sources)
+    _repo_freqs = repo_frequencies
 
+    return repo_frequencies
+
+def get_model_frequencies():
+    """
+    Returns the repo frequencies the model's conditional
+    probabilities are divided by. They are counted over the
+    watches the model uses, so under a heavy watcher policy
+    they are those of the capped or sampled watchlists, or sums
+    of the watch weights. Without a policy these are the repo
+    frequencies.
+    """
+    if not config.HEAVY_WATCHER_POLICY:
+        return get_repo_frequencies()
+
+    path = model_frequencies_path()
+    sources = [_data_path()]
+    global _model_freqs
+    model_frequencies = _model_freqs or util.load_cache(path, sources)
+    if model_frequencies:
+        _model_freqs = model_frequencies
+        return model_frequencies
+
+    model_frequencies = _count_frequencies(get_model_watches(), get_watch_weights())
+
+    util.store_cache(model_frequencies, path, sources)
+    _model_freqs = model_frequencies
+
+    return model_frequencies
+
+def store_repo_frequencies(counts):
+    """
+    Caches repo frequencies counted elsewhere from data.txt, such
+    as by the external model engine, from a dict of repo id keys
+    mapped to their number of watchers.
+    """
+    global _repo_freqs
+    repo_frequencies = RepoFrequencies(dict(counts))
 
-    util.store_pickle(repo_frequencies, path, debug=True)
+    util.store_cache(repo_frequencies, repo_frequencies_path(), [_data_path()])
     _repo_freqs = repo_frequencies
 
     return repo_frequencies
 
+def _count_frequencies(user_watches, weights):
+    counts = collections.defaultdict(int)
+    for user, repos in user_watches.iteritems():
+        weight = weights.get(user, 1)
+        for watch in repos:
+            counts[watch] += weight
+
+    repo_frequencies = RepoFrequencies(dict(counts))
+    logger.debug("Total watches is {0}".format(repo_frequencies.total))
+
+    return repo_frequencies
+
+def get_repo_watchers():
+    """
+    Returns a dict of repo id keys mapped to the set
+    of user ids watching that repo
+    """
+    path = os.path.join(config.CALC_DATA_PATH, 'repo_watchers.pickle')
+    sources = [_data_path()]
+    global _repo_watchers
+    repo_watchers = _repo_watchers or _load_cache(path, _replay_repo_watchers)
+    if repo_watchers:
+        _repo_watchers = repo_watchers
+        return repo_watchers
+
+    repo_watchers = collections.defaultdict(set)
+
+    for user, repos in get_user_watches().iteritems():
+        for repo in repos:
+            repo_watchers[repo].add(user)
+
+    util.store_cache(repo_watchers, path, sources)
+    _repo_watchers = repo_watchers
+
+    return repo_watchers
+
+def add_watches(lines):
+    """
+    Adds a batch of 'user:repo' watch lines. New watches are
+    appended to data.txt, and the user watches, repo watchers
+    and repo frequencies are updated in place. Only what the
+    new watches touch is updated; the cached pickles are left as
+    they are and catch up with data.txt when next loaded. Returns
+    the (user, repo) pairs that were not already being watched.
+
+    Under a heavy watcher policy the model watches and model
+    frequencies are dropped, to be derived again.
+    """
+    global _model_watches, _watch_weights, _model_freqs
+    user_watches = get_user_watches()
+    repo_watchers = get_repo_watchers()
+    repo_frequencies = get_repo_frequencies()
+
+    added = []
+    for line in lines:
+        k,v = line.rstrip().split(':')
+        user, repo = int(k), int(v)
+        if repo in user_watches.get(user, ()):
+            continue
+        user_watches[user].add(repo)
+        repo_watchers[repo].add(user)
+        added.append((user, repo))
+
+    if not added:
+        return added
+
+    logger.debug("Adding {0} new watches".format(len(added)))
+
+    data = open(_data_path(), 'a+')
+    try:
+        data.seek(0, os.SEEK_END)
+        if data.tell() > 0:
+            data.seek(-1, os.SEEK_END)
+            if data.read(1) != '\n':
+                data.write('\n')
+        data.writelines("{0}:{1}\n".format(user, repo) for user, repo in added)
+    finally:
+        data.close()
+
+    for repo in set(repo for user, repo in added):
+        repo_frequencies.set(repo, len(repo_watchers[repo]))
+
+    if config.HEAVY_WATCHER_POLICY:
+        _model_watches = _watch_weights = _model_freqs = None
+
+    return added
+
+# A cache is stored again once the watches replayed onto it
+# reach this share of the data it was built from
+_REPLAY_SHARE = 0.25
+
+def _load_cache(path, replay):
+    """
+    Loads a cache built from data.txt. When watches have only
+    been appended to data.txt since the cache was stored, as
+    add_watches does, they are replayed onto it with
+    replay(cached, watches) instead of building it again.
+    """
+    cached = util.load_cache(path, [_data_path()])
+    if cached is not None:
+        return cached
+
+    offset = util.appended_offset(path, _data_path())
+    if not offset or not _at_line_start(offset):
+        return None
+
+    cached = util.load_pickle(path)
+    logger.debug("Replaying watches appended to data.txt onto {0}".format(path))
+    for user_ids, repo_ids in ingest.iter_watches(offset=offset):
+        replay(cached, itertools.izip(user_ids, repo_ids))
+
+    if os.path.getsize(_data_path()) - offset > offset * _REPLAY_SHARE:
+        util.store_cache(cached, path, [_data_path()])
+
+    return cached
+
+def _at_line_start(offset):
+    """
+    Checks that the bytes appended to data.txt at offset start
+    a new line rather than continue the last one.
+    """
+    data = open(_data_path(), 'rb')
+    try:
+        data.seek(offset - 1)
+        return '\n' in data.read(2)
+    finally:
+        data.close()
+
+def _replay_user_watches(user_watches, watches):
+    for user, repo in watches:
+        user_watches[user].add(repo)
+
+def _replay_repo_watchers(repo_watchers, watches):
+    for user, repo in watches:
+        repo_watchers[repo].add(user)
+
+def _replay_repo_frequencies(repo_frequencies, watches):
+    repo_watchers = get_repo_watchers()
+    for repo in set(repo for user, repo in watches):
+        repo_frequencies.set(repo, len(repo_watchers[repo]))
+
+def repo_frequencies_path():
+    """
+    Path of the cached repo frequencies.
+    """
+    return os.path.join(config.CALC_DATA_PATH, 'repo_frequencies2.pickle')
+
+def model_frequencies_path():
+    """
+    Path of the cached model frequencies of the current heavy
+    watcher policy.
+    """
+    return os.path.join(config.CALC_DATA_PATH, 'model_frequencies{0}.pickle'.format(_policy_suffix()))
+
+def _policy_suffix():
+    """
+    Tells the cached frequencies of each heavy watcher policy apart.
+    """
+    return '-{0}-{1}-{2}'.format(config.HEAVY_WATCHER_POLICY, config.HEAVY_WATCHER_LIMIT,
+                                 config.HEAVY_WATCHER_SEED)
+
+def _data_path():
+    return os.path.join(config.SRC_DATA_PATH, 'data.txt')
+
 def get_test_user_ids():
     """
     Gets the user ids to guess repos for.
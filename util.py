@@ -1,4 +1,8 @@
+import candfile
+import config
+import hashlib
 import logging
+import os
 import os.path
 import pickle
 import simplejson as json
@@ -14,7 +18,11 @@ def load_pickle(path):
 
     logger.debug("Loading pickle file {0}".format(path))
 
-    return pickle.load(open(path))
+    in_ = open(path, 'rb')
+    try:
+        return pickle.load(in_)
+    finally:
+        in_.close()
 
 def store_pickle(obj, path, debug=False, overwrite=False):
     """
@@ -31,7 +39,11 @@ def store_pickle(obj, path, debug=False, overwrite=False):
     
     logger.debug("Dumping pickle {0}".format(path))
     
-    pickle.dump(obj, open(path, "w"))
+    out = open(path, 'wb')
+    try:
+        pickle.dump(obj, out, pickle.HIGHEST_PROTOCOL)
+    finally:
+        out.close()
 
     logger.debug("Finished dumping pickle {0}".format(path))
     
@@ -42,6 +54,151 @@ def store_pickle(obj, path, debug=False, overwrite=False):
         logger.debug("Finished dumping json file {0}".format(json_file.name))
         json_file.close()
 
+def load_cache(path, sources):
+    """
+    Loads a cached object if it was built from the current
+    contents of the source files, otherwise returns None.
+    """
+    if not is_fresh(path, sources):
+        return None
+    return load_pickle(path)
+
+def store_cache(obj, path, sources, debug=None):
+    """
+    Stores an object built from the source files and records
+    the state of the sources in its manifest. JSON dumps are
+    only written when debug (default config.DEBUG_DUMPS) is set.
+    """
+    if debug is None:
+        debug = config.DEBUG_DUMPS
+    store_pickle(obj, path, debug=debug, overwrite=True)
+    write_manifest(path, sources)
+
+def is_fresh(path, sources, settings=None):
+    """
+    Checks the manifest of a cached file against its sources.
+    The size and mtime of each source are compared first; the
+    content hash is only computed when those differ, so touching
+    a source without changing it does not force a rebuild.
+    Settings, if given, must equal the recorded ones.
+    """
+    manifest = _read_manifest(path)
+    if manifest is None or not os.path.exists(path):
+        return False
+
+    if manifest.pop(_settings_key, None) != settings:
+        logger.debug("{0} is stale, its settings changed".format(path))
+        return False
+
+    if sorted(manifest) != sorted(sources):
+        return False
+
+    touched = False
+    for source in sources:
+        if not os.path.exists(source):
+            return False
+
+        recorded = manifest[source]
+        stat = os.stat(source)
+        if stat.st_size != recorded['size']:
+            logger.debug("{0} is stale, {1} changed size".format(path, source))
+            return False
+        if stat.st_mtime != recorded['mtime']:
+            if _hash_file(source) != recorded['md5']:
+                logger.debug("{0} is stale, {1} changed".format(path, source))
+                return False
+            touched = True
+
+    if touched:
+        write_manifest(path, sources, settings)
+
+    return True
+
+def write_manifest(path, sources, settings=None):
+    """
+    Records the size, mtime and hash of each source file
+    next to the cached file at path, along with a dict of
+    the settings it was built with, if any.
+    """
+    manifest = {}
+    if settings is not None:
+        manifest[_settings_key] = settings
+    for source in sources:
+        stat = os.stat(source)
+        manifest[source] = {'size': stat.st_size,
+                            'mtime': stat.st_mtime,
+                            'md5': _hash_file(source)}
+
+    out = open(_manifest_path(path), 'w')
+    try:
+        json.dump(manifest, out, sort_keys=True, indent=2)
+    finally:
+        out.close()
+
+def _read_manifest(path):
+    manifest_path = _manifest_path(path)
+    if not os.path.exists(manifest_path):
+        return None
+
+    in_ = open(manifest_path)
+    try:
+        return json.load(in_)
+    except ValueError:
+        return None
+    finally:
+        in_.close()
+
+# Manifest entry of the settings, which no source path can be
+_settings_key = ''
+
+def _manifest_path(path):
+    return "{0}.manifest".format(path)
+
+def appended_offset(path, source):
+    """
+    Returns the size the source had when the cached file at path
+    was stored from it alone, if the source has only been
+    appended to since; otherwise None.
+    """
+    manifest = _read_manifest(path)
+    if manifest is None or not os.path.exists(path) or manifest.keys() != [source]:
+        return None
+    if not os.path.exists(source):
+        return None
+
+    recorded = manifest[source]
+    if os.path.getsize(source) < recorded['size']:
+        return None
+    if _hash_file(source, recorded['size']) != recorded['md5']:
+        return None
+    return recorded['size']
+
+# Hashes by path, size, mtime and length hashed, so that the
+# manifests written after a change hash each source only once
+_hashes = {}
+
+def _hash_file(path, limit=None, block_size=1 << 20):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime, limit)
+    if key in _hashes:
+        return _hashes[key]
+
+    md5 = hashlib.md5()
+    remaining = stat.st_size if limit is None else limit
+    in_ = open(path, 'rb')
+    try:
+        while remaining > 0:
+            block = in_.read(min(block_size, remaining))
+            if not block:
+                break
+            md5.update(block)
+            remaining -= len(block)
+    finally:
+        in_.close()
+
+    _hashes[key] = md5.hexdigest()
+    return _hashes[key]
+
 def _json_convert(set_):
     """
     Converts a set to a list for JSON dumps
@@ -51,7 +208,16 @@ def _json_convert(set_):
     else:
         raise TypeError("Not a set")
 
-def write_candidates(candidates, out_path, n):
+def write_candidates(candidates, out_path, n, format='text'):
+    """
+    Writes the first n candidates of each user, either as
+    'user:repo,repo,...' lines or, with format='binary', in
+    the packed format of candfile.
+    """
+    if format == 'binary':
+        candfile.write(candidates, out_path, n)
+        return
+
     out = open(out_path, "w")
 
     try:
@@ -64,14 +230,116 @@ def write_candidates(candidates, out_path, n):
         logger.debug("Wrote {0}".format(out.name))
     
 def read_candidates(in_path):
-    candidates = dict()
     logger.debug("Reading candidates from {0}".format(in_path))
+    return dict(iter_candidates(in_path))
+
+def iter_candidates(in_path):
+    """
+    Yields (user, [repo ids]) pairs from a text or binary
+    candidate file, one user at a time.
+    """
+    if candfile.is_binary(in_path):
+        reader = candfile.Reader(in_path)
+        try:
+            for item in reader.iteritems():
+                yield item
+        finally:
+            reader.close()
+        return
+
     for line in open(in_path, 'r'):
         user, repos = line.rstrip().split(':')
         if not repos:
-            candidates[int(user)] = []
+            yield int(user), []
             continue
 
-        candidates[int(user)] = [int(r) for r in repos.split(',')]
+        yield int(user), [int(r) for r in repos.split(',')]
+
+def patch_candidates(path, updates, n):
+    """
+    Replaces the lists of the users in updates, a dict of user ->
+    [repo ids], in a candidate file. Binary files are patched in
+    place; text files are rewritten.
+    """
+    if candfile.is_binary(path):
+        reader = candfile.Reader(path, writable=True)
+        try:
+            for user, suggestions in updates.iteritems():
+                reader.put(user, suggestions)
+        finally:
+            reader.close()
+        return
+
+    candidates = read_candidates(path)
+    candidates.update(updates)
+    write_candidates(candidates, path, n)
+
+class LRUCache:
+    """
+    A bounded mapping that evicts the least recently used
+    key once it holds more than size entries. Keeps count
+    of hits and misses.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._map = {}
+        # Circular doubly linked list of [prev, next, key, value]
+        # links, most recently used first.
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def get(self, key, default=None):
+        link = self._map.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._unlink(link)
+        self._push(link)
+        return link[3]
+
+    def put(self, key, value):
+        link = self._map.get(key)
+        if link is not None:
+            link[3] = value
+            self._unlink(link)
+            self._push(link)
+            return
+
+        if self.size <= 0:
+            return
+
+        if len(self._map) >= self.size:
+            oldest = self._root[0]
+            self._unlink(oldest)
+            del self._map[oldest[2]]
+
+        link = [None, None, key, value]
+        self._push(link)
+        self._map[key] = link
+
+    def clear(self):
+        self._map.clear()
+        self._root[:] = [self._root, self._root, None, None]
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
 
-    return candidates
+    def _push(self, link):
+        root = self._root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = link
+        root[1] = link